@@ -0,0 +1,21 @@
+# Конфигурация gunicorn — подхватывается автоматически при запуске
+# `gunicorn main:app` из корня проекта.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+# Бот упирается в I/O (OpenAI, Postgres, Telegram API), поэтому вместо sync-воркера
+# используем потоки: пока один апдейт ждёт сеть, остальные обрабатываются параллельно.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Потоки gunicorn только принимают апдейт и ставят его в пул EXECUTOR, поэтому их число
+# ограничивает не обработку, а одновременные входящие запросы (Telegram шлёт до 40 параллельно)
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+
+# GUNICORN_WORKER_CLASS=gevent: вместо потоков — гринлеты, сотни одновременных запросов
+# на воркер. gunicorn сам делает monkey.patch_all() до импорта main, psycopg2 патчится
+# в main.py через psycogreen
+if worker_class == "gevent":
+    worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+
+timeout = 120
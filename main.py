@@ -1,16 +1,52 @@
+import atexit
 import os
 import re
-import json
-import traceback
-from typing import Optional, Dict, Tuple, Any
-
+import hashlib
+import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from datetime import datetime, timezone
+from typing import Optional, Dict, List, Tuple, Any
+
+from cachetools import TTLCache
+
+import orjson
 from flask import Flask, request
 from dotenv import load_dotenv
 
 # загрузим .env ДО чтения переменных
 load_dotenv()
 
+# ------------ Логи ------------
+# Обработчики только кладут записи в очередь, в stderr пишет отдельный поток —
+# вывод логов не задерживает апдейты. Подробности по каждому апдейту — на DEBUG
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+_log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(-1)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+log = logging.getLogger("docubridge")
+log.setLevel(LOG_LEVEL)
+log.addHandler(logging.handlers.QueueHandler(_log_queue))
+log.propagate = False
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
 import telebot
+from telebot import apihelper
 from telebot.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -19,67 +55,215 @@ from telebot.types import (
 )
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 from psycopg2 import pool
-from openai import OpenAI
+import redis
+
+# Под gevent-воркером gunicorn сокеты уже пропатчены, а psycopg2 (C-расширение) — нет:
+# без этого каждый запрос в БД блокировал бы весь воркер, а не один гринлет
+if os.getenv("GUNICORN_WORKER_CLASS") == "gevent":
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
 
 # ------------ ENV ------------
 BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 if not BOT_TOKEN:
-    print("ERROR: TELEGRAM_BOT_TOKEN not set")
+    log.error("TELEGRAM_BOT_TOKEN not set")
     raise SystemExit(1)
 
 DB_URL = os.getenv("DATABASE_URL")
 if not DB_URL:
-    print("WARNING: DATABASE_URL не задан — сохранение истории отключено")
+    log.warning("DATABASE_URL не задан — сохранение истории отключено")
 
 WEBHOOK_BASE = os.getenv("WEBHOOK_BASE")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "secret-path")
 PORT = int(os.getenv("PORT", "5000"))
 
+REDIS_URL = os.getenv("REDIS_URL")  # необязателен: кэш состояния диалога
+
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))  # один ID, как на Render
 
 # ------------ App/Bot/AI ------------
 app = Flask(__name__)
+# Один HTTP-сеанс с пулом keep-alive соединений к api.telegram.org на все потоки,
+# чтобы не платить TLS-рукопожатием за каждый вызов Bot API
+tg_session = requests.Session()
+# Повторяем только сбои соединения: повтор POST после таймаута чтения мог бы
+# отправить пользователю одно и то же сообщение дважды
+TG_RETRY = Retry(total=2, connect=2, read=0, backoff_factor=0.1)
+tg_session.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=50, max_retries=TG_RETRY))
+apihelper.session = tg_session
+
 bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
-client = OpenAI(api_key=OPENAI_API_KEY) if OPENAI_API_KEY else None
-print(f"[OpenAI] client is {'ON' if client else 'OFF'}")
-print(f"[ADMIN] Admin ID: {ADMIN_CHAT_ID or '— (не задан)'}")
+AI_ENABLED = bool(OPENAI_API_KEY)
+log.info(f"[OpenAI] client is {'ON' if AI_ENABLED else 'OFF'}")
+
+@lru_cache(maxsize=None)
+def ai_client():
+    """Клиент OpenAI создаётся при первом обращении: импорт openai (httpx, pydantic) —
+    заметная часть холодного старта, а команды и шаги визарда модель не вызывают"""
+    import httpx
+    from openai import DefaultHttpxClient, OpenAI
+    # Один пул keep-alive соединений на все потоки AI_EXECUTOR: TLS-рукопожатие с api.openai.com
+    # делается один раз, а не на каждый запрос
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=AI_WORKERS * 2, max_keepalive_connections=AI_WORKERS,
+                            keepalive_expiry=60),
+    )
+    return OpenAI(api_key=OPENAI_API_KEY, http_client=http_client)
+log.info(f"[ADMIN] Admin ID: {ADMIN_CHAT_ID or '— (не задан)'}")
+
+# ------------ Кэш состояния: в процессе + Redis ------------
+STATE_CACHE_TTL = 300  # сек
+
+rds = redis.Redis.from_url(REDIS_URL, socket_timeout=1, socket_connect_timeout=1) if REDIS_URL else None
+log.info(f"[Redis] state cache is {'ON' if rds else 'OFF'}")
+
+# Первый уровень — словарь в памяти процесса: горячий чат не ходит даже в Redis.
+# Он авторитетен, только пока все записи идут через этот процесс. Число процессов из
+# окружения надёжно не узнать (`gunicorn -w N` из CLI, старый и новый процесс во время
+# деплоя), поэтому по умолчанию выключен: STATE_LOCAL_TTL=60 включать только там, где
+# гарантированно один процесс
+STATE_LOCAL_TTL = float(os.getenv("STATE_LOCAL_TTL", "0"))
+_local_states: Optional[TTLCache] = (
+    TTLCache(maxsize=10_000, ttl=STATE_LOCAL_TTL) if STATE_LOCAL_TTL > 0 else None
+)
+_local_states_lock = threading.Lock()
+
+def _state_key(chat_id: int) -> str:
+    return f"ds:state:{chat_id}"
+
+def cached_state(chat_id: int) -> Optional[Tuple[str, Dict]]:
+    """Достаёт (state, data) из кэша; None — промах или Redis недоступен.
+    data — всегда свежая копия: вызывающий код её меняет."""
+    if _local_states is not None:
+        with _local_states_lock:
+            hit = _local_states.get(chat_id)
+        if hit:
+            return (hit[0], dict(hit[1]))
+    if not rds:
+        return None
+    try:
+        raw = rds.get(_state_key(chat_id))
+        if raw is None:
+            return None
+        state, data = orjson.loads(raw)
+        if _local_states is not None:
+            with _local_states_lock:
+                _local_states[chat_id] = (state, dict(data or {}))
+        return (state, data or {})
+    except Exception as e:
+        log.error(f"[Redis] get error: {e}")
+        return None
+
+def cache_state(chat_id: int, state: str, data: Dict):
+    if _local_states is not None:
+        with _local_states_lock:
+            _local_states[chat_id] = (state, dict(data))
+    if not rds:
+        return
+    try:
+        rds.setex(_state_key(chat_id), STATE_CACHE_TTL, orjson.dumps([state, data]))
+    except Exception as e:
+        log.error(f"[Redis] setex error: {e}")
+
+def invalidate_state(chat_id: int):
+    if _local_states is not None:
+        with _local_states_lock:
+            _local_states.pop(chat_id, None)
+    if not rds:
+        return
+    try:
+        rds.delete(_state_key(chat_id))
+    except Exception as e:
+        log.error(f"[Redis] delete error: {e}")
 
 # ------------ DB Connection Pool ------------
 connection_pool = None
 
+class PreparedConnection(psycopg2.extensions.connection):
+    """Соединение, которое помнит, какие запросы уже подготовлены (PREPARE) на сервере"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+# С БД работают пул апдейтов (UPDATE_WORKERS), потоки gunicorn (claim_update без Redis)
+# и фоновые потоки истории и обслуживания — при всплеске их больше, чем DB_POOL_MAX.
+# ThreadedConnectionPool в этом случае не ждёт, а сразу падает с PoolError, поэтому
+# выдачу соединений ограничивает семафор: лишние потоки ждут освободившееся до DB_CONN_WAIT сек
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "25"))
+DB_CONN_WAIT = float(os.getenv("DB_CONN_WAIT", "10"))
+_conn_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+# Столько соединений открывается сразу при старте — первые апдейты не ждут подключения
+DB_POOL_MIN = min(int(os.getenv("DB_POOL_MIN", "5")), DB_POOL_MAX)
+
 def init_db_pool():
-    """Инициализирует пул соединений с БД"""
+    """Инициализирует пул соединений с БД (потокобезопасный)"""
     global connection_pool
     if not DB_URL:
         return
     try:
-        connection_pool = pool.SimpleConnectionPool(
-            minconn=1,
-            maxconn=10,
+        connection_pool = pool.ThreadedConnectionPool(
+            minconn=DB_POOL_MIN,
+            maxconn=DB_POOL_MAX,
             dsn=DB_URL,
+            connection_factory=PreparedConnection,
             keepalives=1,
             keepalives_idle=30,
             keepalives_interval=10,
             keepalives_count=5,
         )
-        print("[DB] Connection pool created")
+        atexit.register(close_db_pool)
+        log.info("[DB] Connection pool created")
+    except Exception as e:
+        log.error(f"[DB] Pool creation error: {e}")
+
+def close_db_pool():
+    """Закрывает соединения пула при остановке воркера (иначе Postgres держит их до таймаута)"""
+    if connection_pool is None or connection_pool.closed:
+        return
+    try:
+        connection_pool.closeall()
+        log.info("[DB] Connection pool closed")
     except Exception as e:
-        print(f"[DB] Pool creation error: {e}")
+        log.error(f"[DB] Pool close error: {e}")
+
+def discard_idle_connections():
+    """Закрывает все простаивающие соединения пула. После рестарта Postgres или idle-таймаута
+    (автосон Neon) они умирают разом — без этого каждый следующий запрос натыкался бы
+    на очередное мёртвое соединение. Новые пул откроет по требованию."""
+    if connection_pool is None or connection_pool.closed:
+        return
+    # у ThreadedConnectionPool нет публичного API для этого: свободные соединения лежат в _pool
+    with connection_pool._lock:
+        idle, connection_pool._pool = connection_pool._pool, []
+    for conn in idle:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    if idle:
+        log.warning(f"[DB] Discarded {len(idle)} idle pooled connections")
 
 def get_conn():
-    """Получает соединение из пула с проверкой валидности"""
+    """Получает соединение из пула (закрытые отбрасываются)"""
     if not DB_URL:
         return None
 
+    pooled = connection_pool is not None
+    if pooled and not _conn_slots.acquire(timeout=DB_CONN_WAIT):
+        log.error(f"[DB] No free pooled connection within {DB_CONN_WAIT}s")
+        return None
+
     max_retries = 3
     for attempt in range(max_retries):
         try:
-            if not connection_pool:
+            if not pooled:
                 return psycopg2.connect(
                     DB_URL,
+                    connection_factory=PreparedConnection,
                     keepalives=1,
                     keepalives_idle=30,
                     keepalives_interval=10,
@@ -87,55 +271,189 @@ def get_conn():
                 )
 
             conn = connection_pool.getconn()
-            try:
-                cur = conn.cursor()
-                cur.execute("SELECT 1")
-                cur.close()
-                return conn
-            except (psycopg2.OperationalError, psycopg2.InterfaceError) as db_err:
-                print(f"[DB] Dead connection detected: {db_err}")
-                try:
-                    connection_pool.putconn(conn, close=True)
-                except Exception:
-                    pass
-                if attempt < max_retries - 1:
-                    continue
-                raise
+            # Локальная проверка без похода в БД; обрыв, о котором клиент ещё не знает,
+            # ловит with_db_retry на первом настоящем запросе
+            if conn.closed:
+                log.warning("[DB] Dead connection detected in pool")
+                connection_pool.putconn(conn, close=True)
+                continue
+            return conn
         except Exception as e:
-            print(f"[DB] get_conn error (attempt {attempt + 1}/{max_retries}): {e}")
-            if attempt == max_retries - 1:
-                print("[DB] All connection attempts failed")
-                return None
+            log.error(f"[DB] get_conn error (attempt {attempt + 1}/{max_retries}): {e}")
+    log.error("[DB] All connection attempts failed")
+    if pooled:
+        _conn_slots.release()
     return None
 
 def return_conn(conn):
-    """Возвращает соединение в пул"""
+    """Возвращает соединение в пул (оборванное — закрывает, а не отдаёт следующему)"""
     if not conn:
         return
     try:
         if connection_pool:
-            connection_pool.putconn(conn)
+            connection_pool.putconn(conn, close=bool(conn.closed))
         else:
             conn.close()
     except Exception as e:
-        print(f"[DB] return_conn error: {e}")
+        log.error(f"[DB] return_conn error: {e}")
         try:
             conn.close()
         except Exception:
             pass
+    finally:
+        if connection_pool:
+            _conn_slots.release()
 
-def ensure_tables():
-    """Создаёт нужные таблицы (если их нет)"""
-    conn = None
-    if not DB_URL:
+class DBConnectionLost(psycopg2.OperationalError):
+    """Соединение оборвалось ДО COMMIT: транзакция на сервере не применилась,
+    и её можно повторить на другом соединении"""
+
+@contextmanager
+def db_cursor():
+    """Курсор на соединении из пула: COMMIT при успехе, ROLLBACK при ошибке.
+    Обрыв соединения до COMMIT поднимается как DBConnectionLost."""
+    conn = get_conn()
+    if not conn:
+        raise psycopg2.OperationalError("no database connection")
+    committing = False
+    try:
+        with conn.cursor() as cur:
+            yield cur
+        committing = True
+        conn.commit()
+    except Exception as e:
+        try:
+            conn.rollback()
+            reset_prepared(conn)
+        except Exception:
+            pass
+        # Только настоящий обрыв (у ошибок сервера — дедлок, таймаут, лимит соединений —
+        # есть pgcode, соединение живо). Сбой на самом COMMIT не повторяем: ответ сервера
+        # потерян, и транзакция могла уже примениться
+        if (isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError))
+                and e.pgcode is None and conn.closed and not committing):
+            raise DBConnectionLost(str(e)) from e
+        raise
+    finally:
+        return_conn(conn)
+
+def with_db_retry(fn):
+    """Повторяет вызов, если соединение оборвалось до COMMIT (сервер перезапущен, idle-таймаут):
+    упавшее соединение return_conn закрывает, остальные простаивающие (скорее всего, такие же
+    мёртвые) сбрасываются, и повтор идёт на свежеоткрытом соединении.
+    Транзакция на оборванном соединении не была закоммичена, поэтому повтор не дублирует
+    запись; остальные ошибки БД (и сбой на самом COMMIT) пробрасываются без повтора."""
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except DBConnectionLost as e:
+            log.warning(f"[DB] {fn.__name__}: connection lost, retrying on a fresh one: {e}")
+            discard_idle_connections()
+            return fn(*args, **kwargs)
+    return wrapper
+
+def jsonb(obj) -> str:
+    """Параметр для JSONB-колонки: JSON-текст от orjson, в SQL приводится через ::jsonb
+    (без промежуточного адаптера psycopg2.extras.Json)"""
+    return orjson.dumps(obj).decode()
+
+# JSONB из БД тоже разбираем orjson'ом
+psycopg2.extras.register_default_jsonb(globally=True, loads=orjson.loads)
+
+# Горячие запросы парсятся и планируются сервером один раз на соединение
+PREPARED_SQL = {
+    "get_state": "SELECT state, data FROM user_state WHERE chat_id = $1",
+    "update_mark": """
+        INSERT INTO processed_updates (update_id) VALUES ($1)
+        ON CONFLICT DO NOTHING
+        RETURNING update_id
+    """,
+    "set_state": """
+        INSERT INTO user_state (chat_id, state, data, updated_at)
+        VALUES ($1, $2, $3::jsonb, NOW())
+        ON CONFLICT (chat_id) DO UPDATE
+          SET state = EXCLUDED.state,
+              data  = COALESCE(EXCLUDED.data, user_state.data),
+              updated_at = NOW()
+    """,
+    "merge_data": """
+        INSERT INTO user_state (chat_id, state, data, updated_at)
+        VALUES ($1, 'collecting', $2::jsonb, NOW())
+        ON CONFLICT (chat_id) DO UPDATE
+          SET data = COALESCE(user_state.data, '{}'::jsonb) || EXCLUDED.data,
+              updated_at = NOW()
+        RETURNING state, data
+    """,
+}
+
+def execute_prepared(cur, name: str, params: tuple):
+    """EXECUTE подготовленного запроса; PREPARE — лениво, при первом вызове на соединении"""
+    prepared = cur.connection.prepared
+    if name not in prepared:
+        cur.execute(f"PREPARE {name} AS {PREPARED_SQL[name]}")
+        prepared.add(name)
+    cur.execute(f"EXECUTE {name} ({', '.join(['%s'] * len(params))})", params)
+
+@with_db_retry
+def query_prepared(name: str, params: tuple):
+    """Подготовленный запрос в своей транзакции; возвращает первую строку результата (или None)"""
+    with db_cursor() as cur:
+        execute_prepared(cur, name, params)
+        return cur.fetchone() if cur.description else None
+
+def reset_prepared(conn):
+    """После ROLLBACK сбрасывает подготовленные запросы, чтобы флаги не разошлись с сервером"""
+    prepared = getattr(conn, "prepared", None)
+    if not prepared:
         return
+    with conn.cursor() as cur:
+        cur.execute("DEALLOCATE ALL")
+    conn.commit()
+    prepared.clear()
+
+# Версия схемы: увеличивать при каждом изменении DDL в ensure_tables
+SCHEMA_VERSION = 3
+SCHEMA_SENTINEL = os.getenv("SCHEMA_SENTINEL", "/tmp/ds_tables_ready")
+
+def _schema_stamp() -> str:
+    """Отметка «схема версии N применена к этой БД» (хэш, чтобы не писать DSN на диск)"""
+    return f"{SCHEMA_VERSION}:{hashlib.sha1(DB_URL.encode()).hexdigest()[:12]}"
+
+def schema_ready() -> bool:
     try:
-        conn = get_conn()
-        if not conn:
-            print("[DB] ensure_tables: Failed to get connection")
-            return
+        with open(SCHEMA_SENTINEL, encoding="utf-8") as f:
+            return f.read().strip() == _schema_stamp()
+    except OSError:
+        return False
+
+def mark_schema_ready():
+    try:
+        with open(SCHEMA_SENTINEL, "w", encoding="utf-8") as f:
+            f.write(_schema_stamp())
+    except OSError as e:
+        log.error(f"[DB] schema sentinel write error: {e}")
+
+@with_db_retry
+def _read_schema_version() -> int:
+    with db_cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+        if not cur.fetchone()[0]:
+            return 0
+        cur.execute("SELECT COALESCE(MAX(v), 0) FROM schema_version")
+        return cur.fetchone()[0]
+
+def db_schema_version() -> int:
+    """Версия схемы, записанная в самой БД (0 — таблицы schema_version ещё нет)"""
+    try:
+        return _read_schema_version()
+    except Exception as e:
+        log.error(f"[DB] schema version check error: {e}")
+        return 0
 
-        cur = conn.cursor()
+@with_db_retry
+def _apply_schema():
+    with db_cursor() as cur:
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS chat_history (
@@ -170,219 +488,637 @@ def ensure_tables():
 
             CREATE INDEX IF NOT EXISTS chat_history_ts_idx
               ON chat_history (timestamp DESC);
-            """
-        )
-        conn.commit()
-        cur.close()
-        print("[DB] ensure_tables OK")
-    except Exception as e:
-        print(f"[DB] ensure_tables error: {e}")
-    finally:
-        if conn:
-            return_conn(conn)
 
-def is_update_processed(update_id: int) -> bool:
-    """Проверяет, было ли обновление уже обработано"""
-    conn = None
-    if not DB_URL:
-        return False
-    try:
-        conn = get_conn()
-        if not conn:
-            return False
+            CREATE INDEX IF NOT EXISTS idx_chat_history_chat_ts
+              ON chat_history (chat_id, timestamp DESC);
 
-        cur = conn.cursor()
+            CREATE TABLE IF NOT EXISTS schema_version (
+              v INT PRIMARY KEY,
+              applied_at TIMESTAMPTZ DEFAULT NOW()
+            );
+            """
+        )
         cur.execute(
-            "SELECT 1 FROM processed_updates WHERE update_id = %s",
-            (update_id,),
+            "INSERT INTO schema_version (v) VALUES (%s) ON CONFLICT DO NOTHING",
+            (SCHEMA_VERSION,),
         )
-        exists = cur.fetchone() is not None
-        cur.close()
-        return exists
-    except Exception as e:
-        print(f"[DB] is_update_processed error: {e}")
-        return False
-    finally:
-        if conn:
-            return_conn(conn)
 
-def mark_update_processed(update_id: int):
-    """Отмечает обновление как обработанное"""
-    conn = None
+def ensure_tables():
+    """Создаёт нужные таблицы (если их нет)"""
     if not DB_URL:
         return
+    if schema_ready():
+        log.info("[DB] ensure_tables: schema already in place, skipping DDL")
+        return
+    # Sentinel нет (новый контейнер/воркер), но схема в БД может уже быть нужной версии
+    if db_schema_version() >= SCHEMA_VERSION:
+        mark_schema_ready()
+        log.info(f"[DB] ensure_tables: schema v{SCHEMA_VERSION} found in DB, skipping DDL")
+        return
     try:
-        conn = get_conn()
-        if not conn:
-            print("[DB] mark_update_processed: Failed to get connection")
-            return
-
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO processed_updates (update_id) VALUES (%s) ON CONFLICT DO NOTHING",
-            (update_id,),
-        )
-        conn.commit()
-        cur.close()
+        _apply_schema()
+        mark_schema_ready()
+        log.info("[DB] ensure_tables OK")
     except Exception as e:
-        print(f"[DB] mark_update_processed error: {e}")
-    finally:
-        if conn:
-            return_conn(conn)
+        log.error(f"[DB] ensure_tables error: {e}")
+
+# Telegram хранит неподтверждённые апдейты до 24 часов — столько же помним update_id
+UPDATE_DEDUP_TTL = 24 * 3600
+
+# update_id, уже встреченные этим процессом: повторная доставка того же апдейта
+# (Telegram ретраит при медленном ответе) отсекается без похода в Redis/Postgres
+_seen_updates = TTLCache(maxsize=50_000, ttl=UPDATE_DEDUP_TTL)
+_seen_updates_lock = threading.Lock()
+
+def claim_update(update_id: int) -> bool:
+    """Атомарно отмечает обновление как обработанное.
+    True — апдейт новый (его надо обработать), False — повторная доставка.
+    Сначала локальный кэш; дальше с Redis — один SET NX, без Postgres;
+    без Redis или при его сбое — INSERT в processed_updates."""
+    with _seen_updates_lock:
+        if update_id in _seen_updates:
+            return False
+        _seen_updates[update_id] = True
+    if rds:
+        try:
+            return bool(rds.set(f"ds:upd:{update_id}", 1, nx=True, ex=UPDATE_DEDUP_TTL))
+        except Exception as e:
+            log.error(f"[Redis] dedup error, fallback to DB: {e}")
+    if not DB_URL:
+        return True
+    try:
+        return query_prepared("update_mark", (update_id,)) is not None
+    except Exception as e:
+        # БД недоступна — лучше обработать возможный дубль, чем потерять сообщение
+        log.error(f"[DB] claim_update error: {e}")
+        return True
+
+# Удаляем пачками по CLEANUP_BATCH строк, каждая пачка — своя короткая транзакция:
+# большой разовый DELETE держал бы блокировки и раздувал WAL
+CLEANUP_BATCH = 10_000
+
+@with_db_retry
+def _delete_batch(sql: str, params: Tuple) -> int:
+    with db_cursor() as cur:
+        cur.execute(sql, params)
+        return cur.rowcount
+
+def _delete_in_batches(table: str, ts_column: str, interval_sql: str, params: Tuple = ()) -> int:
+    sql = (
+        f"DELETE FROM {table} WHERE ctid IN ("
+        f"SELECT ctid FROM {table} WHERE {ts_column} < NOW() - {interval_sql} LIMIT {CLEANUP_BATCH})"
+    )
+    total = 0
+    while True:
+        deleted = _delete_batch(sql, params)
+        total += deleted
+        if deleted < CLEANUP_BATCH:
+            return total
 
 def cleanup_old_updates():
     """Удаляет записи старше 7 дней из processed_updates"""
-    conn = None
     if not DB_URL:
         return
     try:
-        conn = get_conn()
-        if not conn:
-            print("[DB] cleanup_old_updates: Failed to get connection")
-            return
+        deleted = _delete_in_batches("processed_updates", "processed_at", "INTERVAL '7 days'")
+        log.info(f"[DB] Cleaned up {deleted} old update records")
+    except Exception as e:
+        log.error(f"[DB] cleanup_old_updates error: {e}")
 
-        cur = conn.cursor()
-        cur.execute(
-            """
-            DELETE FROM processed_updates
-            WHERE processed_at < NOW() - INTERVAL '7 days'
-            """
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "90"))
+
+def cleanup_old_history():
+    """Удаляет историю переписки старше HISTORY_RETENTION_DAYS дней"""
+    if not DB_URL:
+        return
+    try:
+        deleted = _delete_in_batches(
+            "chat_history", "timestamp", "make_interval(days => %s)", (HISTORY_RETENTION_DAYS,)
         )
-        deleted = cur.rowcount
-        conn.commit()
-        cur.close()
-        print(f"[DB] Cleaned up {deleted} old update records")
+        log.info(f"[DB] Cleaned up {deleted} old chat_history rows")
     except Exception as e:
-        print(f"[DB] cleanup_old_updates error: {e}")
-    finally:
-        if conn:
-            return_conn(conn)
+        log.error(f"[DB] cleanup_old_history error: {e}")
+
+# Раз в час чистим служебные таблицы: пачки остаются маленькими, а таблица
+# дедупликации не успевает разрастись между проходами
+MAINTENANCE_INTERVAL = 3600
+
+def _maintenance_loop():
+    while True:
+        time.sleep(MAINTENANCE_INTERVAL)
+        cleanup_old_updates()
+        cleanup_old_history()
+
+if DB_URL:
+    threading.Thread(target=_maintenance_loop, name="db-maintenance", daemon=True).start()
+
+# История пишется пачками: save_message только кладёт строку в буфер,
+# фоновый поток раз в HISTORY_FLUSH_INTERVAL сек сбрасывает его одним INSERT
+HISTORY_FLUSH_INTERVAL = 0.2  # сек
+# До HISTORY_BATCH строк за один INSERT; при наплыве пачка уходит, не дожидаясь таймера
+HISTORY_BATCH = 256
+# Ограничение очереди: если БД подвисла, память не растёт бесконечно — лишние строки теряем
+HISTORY_QUEUE_MAX = 10_000
+_history_q: "queue.Queue[Tuple[int, Optional[str], Optional[str], datetime]]" = queue.Queue(HISTORY_QUEUE_MAX)
 
 def save_message(chat_id: int, user_text: Optional[str], bot_reply: Optional[str]):
-    """Сохраняет сообщение пользователя/бота в историю"""
-    conn = None
+    """Сохраняет сообщение пользователя/бота в историю (через очередь, не блокируя)"""
+    if not DB_URL:
+        return
     try:
-        if DB_URL:
-            conn = get_conn()
-            if not conn:
-                print("[DB] save_message: Failed to get connection")
-                return
-            cur = conn.cursor()
-            cur.execute(
-                """
-                INSERT INTO chat_history (chat_id, user_message, bot_reply)
-                VALUES (%s, %s, %s)
-                """,
-                (int(chat_id), user_text, bot_reply),
-            )
-            conn.commit()
-            cur.close()
+        _history_q.put_nowait((chat_id, user_text, bot_reply, datetime.now(timezone.utc)))
+    except queue.Full:
+        log.warning(f"[DB] history queue full, message dropped (chat {chat_id})")
+
+@with_db_retry
+def _insert_history(rows: List[Tuple[int, Optional[str], Optional[str], datetime]]):
+    with db_cursor() as cur:
+        psycopg2.extras.execute_values(
+            cur,
+            "INSERT INTO chat_history (chat_id, user_message, bot_reply, timestamp) VALUES %s",
+            rows,
+            page_size=HISTORY_BATCH,
+        )
+
+def _write_history(rows: List[Tuple[int, Optional[str], Optional[str], datetime]]):
+    """Записывает пачку сообщений одним многострочным INSERT"""
+    try:
+        _insert_history(rows)
     except Exception as e:
-        print(f"[DB] save_message error: {e}")
-    finally:
-        if conn:
-            return_conn(conn)
+        log.error(f"[DB] flush_history error ({len(rows)} rows dropped): {e}")
+
+def flush_history():
+    """Дописывает всё, что осталось в очереди (вызывается при остановке)"""
+    while True:
+        rows = []
+        try:
+            while len(rows) < HISTORY_BATCH:
+                rows.append(_history_q.get_nowait())
+        except queue.Empty:
+            pass
+        if rows:
+            _write_history(rows)
+        if len(rows) < HISTORY_BATCH:
+            return
+
+def _history_flusher():
+    while True:
+        rows = [_history_q.get()]
+        deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+        while len(rows) < HISTORY_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                rows.append(_history_q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        _write_history(rows)
+
+if DB_URL:
+    threading.Thread(target=_history_flusher, name="history-flush", daemon=True).start()
 
 def get_state(chat_id: int) -> Tuple[str, Dict]:
-    conn = None
+    if not DB_URL:
+        return ("greeting", {})
+    cached = cached_state(chat_id)
+    if cached:
+        return cached
     try:
-        if not DB_URL:
-            return ("greeting", {})
-
-        conn = get_conn()
-        if not conn:
-            return ("greeting", {})
-
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("SELECT state, data FROM user_state WHERE chat_id = %s", (int(chat_id),))
-        row = cur.fetchone()
-        cur.close()
-        return (row["state"], row["data"] or {}) if row else ("greeting", {})
+        row = query_prepared("get_state", (chat_id,))
+        result = (row[0], row[1] or {}) if row else ("greeting", {})
+        cache_state(chat_id, *result)
+        return result
     except Exception as e:
-        print(f"[DB] get_state error: {e}")
+        log.error(f"[DB] get_state error: {e}")
         return ("greeting", {})
-    finally:
-        if conn:
-            return_conn(conn)
 
 def set_state(chat_id: int, state: str, data: Optional[Dict] = None):
-    conn = None
+    if not DB_URL:
+        return
     try:
-        if not DB_URL:
-            return
+        query_prepared("set_state", (chat_id, state, jsonb(data or {})))
+        cache_state(chat_id, state, data or {})
+    except Exception as e:
+        log.error(f"[DB] set_state error: {e}")
+        invalidate_state(chat_id)
 
-        conn = get_conn()
-        if not conn:
-            print("[DB] set_state: Failed to get connection")
-            return
+def merge_data(chat_id: int, patch: Dict) -> Optional[Tuple[str, Dict]]:
+    """Дописывает patch в data на стороне БД (data || patch) одним запросом,
+    без чтения-изменения-записи; возвращает итоговые (state, data)."""
+    if not DB_URL:
+        return None
+    try:
+        state, data = query_prepared("merge_data", (chat_id, jsonb(patch)))
+        cache_state(chat_id, state, data or {})
+        return (state, data or {})
+    except Exception as e:
+        log.error(f"[DB] merge_data error: {e}")
+        invalidate_state(chat_id)
+        return None
 
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO user_state (chat_id, state, data, updated_at)
-            VALUES (%s, %s, %s, NOW())
-            ON CONFLICT (chat_id) DO UPDATE
-              SET state = EXCLUDED.state,
-                  data  = COALESCE(EXCLUDED.data, user_state.data),
-                  updated_at = NOW()
-            """,
-            (int(chat_id), state, json.dumps(data or {})),
+@with_db_retry
+def _run_turn(sql: str, params: List) -> tuple:
+    with db_cursor() as cur:
+        cur.execute(sql, params)
+        return cur.fetchone()
+
+def persist_turn(
+    chat_id: int,
+    user_text: Optional[str],
+    bot_reply: Optional[str],
+    new_data: Optional[Dict] = None,
+    new_state: Optional[str] = None,
+    lead_payload: Optional[Dict] = None,
+) -> Optional[int]:
+    """Пишет все изменения одного хода диалога одним SQL-запросом (CTE) — один round-trip.
+
+    new_state — как set_state (данные заменяются на new_data или {}),
+    иначе new_data заменяет data без смены состояния. lead_payload — запись в leads.
+    Возвращает id созданного лида (если он был).
+    """
+    if not DB_URL:
+        return None
+
+    ctes, params = [], []
+    if lead_payload is not None:
+        ctes.append("lead AS (INSERT INTO leads (chat_id, payload) VALUES (%s, %s::jsonb) RETURNING id)")
+        params += [chat_id, jsonb(lead_payload)]
+    if user_text is not None or bot_reply is not None:
+        ctes.append(
+            "hist AS (INSERT INTO chat_history (chat_id, user_message, bot_reply) VALUES (%s, %s, %s))"
         )
-        conn.commit()
-        cur.close()
-    except Exception as e:
-        print(f"[DB] set_state error: {e}")
-    finally:
-        if conn:
-            return_conn(conn)
+        params += [chat_id, user_text, bot_reply]
+    if new_state:
+        ctes.append(
+            """st AS (
+                INSERT INTO user_state (chat_id, state, data, updated_at)
+                VALUES (%s, %s, %s::jsonb, NOW())
+                ON CONFLICT (chat_id) DO UPDATE
+                  SET state = EXCLUDED.state,
+                      data  = EXCLUDED.data,
+                      updated_at = NOW()
+                RETURNING state
+            )"""
+        )
+        params += [chat_id, new_state, jsonb(new_data or {})]
+    elif new_data is not None:
+        ctes.append(
+            """st AS (
+                UPDATE user_state
+                   SET data = %s::jsonb, updated_at = NOW()
+                 WHERE chat_id = %s
+                RETURNING state
+            )"""
+        )
+        params += [jsonb(new_data), chat_id]
+    if not ctes:
+        return None
 
-def update_data(chat_id: int, new_data: Dict):
-    conn = None
+    writes_state = bool(new_state) or new_data is not None
+    select_lead = "(SELECT id FROM lead)" if lead_payload is not None else "NULL"
+    select_state = "(SELECT state FROM st)" if writes_state else "NULL"
     try:
-        if not DB_URL:
-            return
+        lead_id, state = _run_turn(f"WITH {', '.join(ctes)} SELECT {select_lead}, {select_state}", params)
+        if writes_state:
+            if state:
+                cache_state(chat_id, state, new_data or {})
+            else:
+                invalidate_state(chat_id)
+        return lead_id
+    except Exception as e:
+        log.error(f"[DB] persist_turn error: {e}")
+        invalidate_state(chat_id)
+        return None
 
-        conn = get_conn()
-        if not conn:
-            print("[DB] update_data: Failed to get connection")
-            return
+# ------------ OpenAI (общие ответы) ------------
+# Системные промпты неизменны побайтно: OpenAI кэширует общий префикс запросов.
+# Кэш включается с префикса от 1024 токенов, поэтому SYS_EXTRACT дополнен правилами
+# и примерами — заодно они стабилизируют формат ответа (сейчас ≈1295 токенов o200k_base;
+# при правке промпта перемерить tiktoken'ом). Никаких дат/подстановок сюда
+SYS_CHAT = "Ты вежливый логист-ассистент DocuBridge. Отвечай по делу и кратко, на русском."
+
+SYS_EXTRACT = (
+    "Ты логистический ассистент DocuBridge. "
+    "Тебе дают свободный текст. Извлеки поля заявки "
+    "(doc_type, from_country, from_city, to_country, to_city, pages_a4, weight_grams, urgency, name, phone, email, best_time). "
+    "Верни ТОЛЬКО валидный JSON-объект без лишнего текста. Неуказанные поля не включай.\n"
+    "\n"
+    "Правила полей:\n"
+    "- doc_type: тип документа словами пользователя (доверенность, диплом, свидетельство о рождении, "
+    "справка, апостиль, договор, выписка и т.п.), строчными буквами.\n"
+    "- from_country / to_country: ТОЛЬКО одно из значений \"Украина\", \"Россия\", \"Беларусь\". "
+    "Сокращения и формы слов приводи к этим значениям (РФ, Рашка, из России → \"Россия\"; РБ, Белоруссия, "
+    "из Беларуси → \"Беларусь\"; UA, из Украины, с Украины → \"Украина\").\n"
+    "- from_city / to_city: название города в именительном падеже с заглавной буквы "
+    "(из Киева → \"Киев\", в Минск → \"Минск\", до Москвы → \"Москва\").\n"
+    "- pages_a4: целое число листов A4; числительные словами переводи в цифры (десять → 10).\n"
+    "- weight_grams: целое число граммов, только если вес назван явно; килограммы переводи в граммы.\n"
+    "- urgency: ТОЛЬКО \"обычная\" или \"срочная\" (срочно, экспресс, побыстрее, ускоренно → \"срочная\"; "
+    "не горит, стандартно, обычно → \"обычная\").\n"
+    "- name: имя и/или фамилия, как их написал пользователь.\n"
+    "- phone: номер в международном формате с плюсом, без пробелов, скобок и дефисов.\n"
+    "- email: адрес электронной почты как есть.\n"
+    "- best_time: удобное время связи словами пользователя (утром, после 18:00, в выходные).\n"
+    "Если текст — приветствие, вопрос о цене или сроках без данных заявки, верни пустой объект {}.\n"
+    "Ничего не придумывай: поле включается только если оно прямо следует из текста.\n"
+    "\n"
+    "Примеры:\n"
+    "Текст пользователя:\nНужно отправить доверенность из Киева в Минск, 3 листа, срочно\n"
+    "Ответ: {\"doc_type\": \"доверенность\", \"from_country\": \"Украина\", \"from_city\": \"Киев\", "
+    "\"to_country\": \"Беларусь\", \"to_city\": \"Минск\", \"pages_a4\": 3, \"urgency\": \"срочная\"}\n"
+    "\n"
+    "Текст пользователя:\nДиплом с приложением, десять страниц, из Москвы в Харьков\n"
+    "Ответ: {\"doc_type\": \"диплом с приложением\", \"from_country\": \"Россия\", \"from_city\": \"Москва\", "
+    "\"to_country\": \"Украина\", \"to_city\": \"Харьков\", \"pages_a4\": 10}\n"
+    "\n"
+    "Текст пользователя:\nМеня зовут Ольга Петренко, телефон +380 67 123-45-67, почта olga.p@example.com, звонить после обеда\n"
+    "Ответ: {\"name\": \"Ольга Петренко\", \"phone\": \"+380671234567\", \"email\": \"olga.p@example.com\", "
+    "\"best_time\": \"после обеда\"}\n"
+    "\n"
+    "Текст пользователя:\nСвидетельство о рождении из РБ в Питер, вес около 40 грамм, не горит\n"
+    "Ответ: {\"doc_type\": \"свидетельство о рождении\", \"from_country\": \"Беларусь\", "
+    "\"to_country\": \"Россия\", \"to_city\": \"Санкт-Петербург\", \"weight_grams\": 40, \"urgency\": \"обычная\"}\n"
+    "\n"
+    "Текст пользователя:\nЗдравствуйте, сколько стоит доставка?\n"
+    "Ответ: {}\n"
+    "\n"
+    "Текст пользователя:\nПакет договоров на 25 листов, Гомель → Одесса, контакт Иван, +375291112233\n"
+    "Ответ: {\"doc_type\": \"договоры\", \"from_country\": \"Беларусь\", \"from_city\": \"Гомель\", "
+    "\"to_country\": \"Украина\", \"to_city\": \"Одесса\", \"pages_a4\": 25, \"name\": \"Иван\", "
+    "\"phone\": \"+375291112233\"}\n"
+    "\n"
+    "Текст пользователя:\nСправка о несудимости, 2 страницы, из Харькова в Брест, обычная доставка\n"
+    "Ответ: {\"doc_type\": \"справка о несудимости\", \"from_country\": \"Украина\", \"from_city\": \"Харьков\", "
+    "\"to_country\": \"Беларусь\", \"to_city\": \"Брест\", \"pages_a4\": 2, \"urgency\": \"обычная\"}\n"
+    "\n"
+    "Текст пользователя:\nАпостиль на выписку, вес 0,1 кг, из Минска в Москву, побыстрее\n"
+    "Ответ: {\"doc_type\": \"апостиль на выписку\", \"from_country\": \"Беларусь\", \"from_city\": \"Минск\", "
+    "\"to_country\": \"Россия\", \"to_city\": \"Москва\", \"weight_grams\": 100, \"urgency\": \"срочная\"}\n"
+    "\n"
+    "Текст пользователя:\nПишите на ivan.s@example.org, удобнее утром\n"
+    "Ответ: {\"email\": \"ivan.s@example.org\", \"best_time\": \"утром\"}\n"
+    "\n"
+    "Текст пользователя:\nСпасибо, понял. А сколько идёт по времени?\n"
+    "Ответ: {}\n"
+    "\n"
+    "Текст пользователя:\nДоверенность, пятнадцать листов, из Новосибирска в Гродно, Анна, +7 (913) 000-11-22, в выходные\n"
+    "Ответ: {\"doc_type\": \"доверенность\", \"from_country\": \"Россия\", \"from_city\": \"Новосибирск\", "
+    "\"to_country\": \"Беларусь\", \"to_city\": \"Гродно\", \"pages_a4\": 15, \"name\": \"Анна\", "
+    "\"phone\": \"+79130001122\", \"best_time\": \"в выходные\"}\n"
+)
 
-        cur = conn.cursor()
-        cur.execute(
-            """
-            UPDATE user_state
-               SET data = %s, updated_at = NOW()
-             WHERE chat_id = %s
-            """,
-            (json.dumps(new_data), int(chat_id)),
-        )
-        conn.commit()
-        cur.close()
+# Пул для вызовов OpenAI, идущих параллельно с остальной работой обработчика.
+# Отдельный от EXECUTOR: задача, ждущая другую задачу в том же пуле, может его исчерпать.
+AI_WORKERS = int(os.getenv("AI_WORKERS", "8"))
+AI_EXECUTOR = ThreadPoolExecutor(max_workers=AI_WORKERS, thread_name_prefix="ai")
+
+AI_MODEL = "gpt-4o-mini"
+# Свободные ответы не кэшируются: при 0.6 кэш «заморозил» бы один случайный вариант на часы
+AI_REPLY_TEMPERATURE = 0.6
+
+# Точный кэш извлечения полей (temperature=0, результат стабилен): одинаковые тексты
+# приходят постоянно, и повторный поход в OpenAI для них — лишние секунды и деньги
+AI_CACHE_TTL = 6 * 3600
+_ai_cache: TTLCache = TTLCache(maxsize=2048, ttl=AI_CACHE_TTL)
+_ai_cache_lock = threading.Lock()
+
+def ai_cache_key(model: str, system: str, user: str) -> str:
+    return hashlib.blake2b(f"{model}\n{system}\n{user}".encode(), digest_size=16).hexdigest()
+
+# Второй уровень — Redis: ответы переживают рестарт и общие для всех воркеров gunicorn
+def _ai_redis_key(key: str) -> str:
+    return f"ds:ai:{key}"
+
+def ai_cache_get(key: str) -> Any:
+    with _ai_cache_lock:
+        value = _ai_cache.get(key)
+    if value is not None or not rds:
+        return value
+    try:
+        raw = rds.get(_ai_redis_key(key))
+        if raw is None:
+            return None
+        value = orjson.loads(raw)
+    except orjson.JSONDecodeError as e:
+        # битое или чужое значение под нашим ключом — считаем промахом
+        log.warning(f"[Redis] ai cache bad value for {key}: {e}")
+        return None
+    except Exception as e:
+        log.error(f"[Redis] ai cache get error: {e}")
+        return None
+    with _ai_cache_lock:
+        _ai_cache[key] = value
+    return value
+
+def ai_cache_put(key: str, value: Any) -> None:
+    with _ai_cache_lock:
+        _ai_cache[key] = value
+    if not rds:
+        return
+    try:
+        rds.setex(_ai_redis_key(key), AI_CACHE_TTL, orjson.dumps(value))
     except Exception as e:
-        print(f"[DB] update_data error: {e}")
+        log.error(f"[Redis] ai cache setex error: {e}")
+
+# Тексты с телефоном/почтой не кэшируем: повторно они не встретятся, а персональные
+# данные незачем держать в общем кэше
+_CONTACT_RE = re.compile(r"[^@\s]+@[^@\s]+\.\w+|\+?\d[\d\s\-()]{8,}\d")
+
+def has_contact_data(text: str) -> bool:
+    return bool(_CONTACT_RE.search(text))
+
+# Одинаковые запросы, пришедшие одновременно (кэш ещё пуст), делят один вызов модели:
+# первый поток идёт в OpenAI, остальные ждут его результат
+_inflight: Dict[str, Future] = {}
+_inflight_lock = threading.Lock()
+
+def single_flight(key: str, fn) -> Any:
+    with _inflight_lock:
+        fut = _inflight.get(key)
+        owner = fut is None
+        if owner:
+            fut = _inflight[key] = Future()
+    if not owner:
+        return fut.result()
+    try:
+        result = fn()
+        fut.set_result(result)
+        return result
+    except BaseException as e:
+        fut.set_exception(e)
+        raise
     finally:
-        if conn:
-            return_conn(conn)
+        with _inflight_lock:
+            _inflight.pop(key, None)
+
+def ai_user_kwargs(chat_id: Optional[int], prompt: str) -> Dict[str, str]:
+    """prompt_cache_key — один на системный промпт, а не на чат: все запросы с общим
+    префиксом маршрутизируются на один шард кэша OpenAI. Чат уходит в safety_identifier."""
+    kwargs = {"prompt_cache_key": f"docubridge-{prompt}"}
+    if chat_id:
+        kwargs["safety_identifier"] = str(chat_id)
+    return kwargs
+
+# Короткие реплики вежливости отвечаем шаблоном: модель тут ничем не лучше, а стоит секунды
+SHORT_REPLIES = {
+    "спасибо": "Пожалуйста! Если понадобится отправить документы — я на связи.",
+    "спс": "Пожалуйста!",
+    "благодарю": "Пожалуйста! Обращайтесь.",
+    "ок": "Принято.",
+    "окей": "Принято.",
+    "хорошо": "Принято.",
+    "понятно": "Если появятся вопросы — пишите.",
+    "ясно": "Если появятся вопросы — пишите.",
+    "пока": "До свидания! Будем рады помочь с доставкой документов.",
+    "до свидания": "До свидания! Будем рады помочь с доставкой документов.",
+}
+GREETING_REPLY = (
+    "Здравствуйте! Я помогу отправить документы между Украиной, Россией и Беларусью. "
+    "Опишите, что и куда нужно доставить, или нажмите /consult."
+)
+_GREETING_RE = re.compile(
+    r"^(привет|здравствуйте|здравствуй|добрый (?:день|вечер|утро)|доброе утро|hi|hello)\W*$", re.I
+)
+_TRAILING_PUNCT_RE = re.compile(r"[\s!.,)]+$")
 
-# ------------ OpenAI (общие ответы) ------------
-def ai_reply(text: str) -> str:
-    if not client:
-        return "Сейчас умные ответы временно недоступны. Опишите задачу — менеджер поможет."
+def canned_reply(text: str) -> Optional[str]:
+    """Шаблонный ответ на приветствие/благодарность или None"""
+    s = (text or "").strip().lower()
+    if len(s) > 20:
+        return None
+    if _GREETING_RE.match(s):
+        return GREETING_REPLY
+    return SHORT_REPLIES.get(_TRAILING_PUNCT_RE.sub("", s))
+
+AI_REPLY_MAX_TOKENS = 500
+AI_REPLY_MIN_TOKENS = 200  # короткий вопрос («сколько стоит?») не значит короткий ответ
+
+def reply_token_budget(text: str) -> int:
+    """max_tokens для ответа: растёт с длиной вопроса (≈4 символа на токен)"""
+    approx = len(text) // 4
+    return min(AI_REPLY_MAX_TOKENS, max(AI_REPLY_MIN_TOKENS, 64 + 2 * approx))
+
+AI_OFF_TEXT = "Сейчас умные ответы временно недоступны. Опишите задачу — менеджер поможет."
+AI_ERROR_TEXT = "Небольшая пауза на стороне ИИ. Попробуйте ещё раз."
+
+def quick_reply(text: str) -> Optional[str]:
+    """Ответ без обращения к модели: шаблон или заглушка при выключенном ИИ"""
+    canned = canned_reply(text)
+    if canned:
+        return canned
+    if not AI_ENABLED:
+        return AI_OFF_TEXT
+    return None
+
+def reply_request(text: str, chat_id: Optional[int], **extra) -> Any:
+    return ai_client().chat.completions.create(
+        model=AI_MODEL,
+        messages=[
+            {"role": "system", "content": SYS_CHAT},
+            {"role": "user", "content": text},
+        ],
+        temperature=AI_REPLY_TEMPERATURE,
+        max_tokens=reply_token_budget(text),
+        timeout=30,
+        **ai_user_kwargs(chat_id, "chat"),
+        **extra,
+    )
+
+def fetch_reply(text: str, chat_id: Optional[int] = None) -> str:
+    """Ответ модели целиком, без стриминга (проверка /ai)"""
     try:
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "Ты вежливый логист-ассистент DocuBridge. Отвечай по делу и кратко, на русском."},
-                {"role": "user", "content": text},
-            ],
-            temperature=0.6,
-            max_tokens=500,
-            timeout=30,
-        )
+        r = reply_request(text, chat_id)
         return r.choices[0].message.content.strip()
     except Exception as e:
-        print(f"[OpenAI] error: {e}")
-        return "Небольшая пауза на стороне ИИ. Попробуйте ещё раз."
+        log.error(f"[OpenAI] error: {e}")
+        return AI_ERROR_TEXT
+
+# Telegram позволяет править сообщение в чате примерно раз в секунду
+STREAM_EDIT_INTERVAL = 1.0
+
+class ReplyStream:
+    """Ответ модели в режиме stream=True: генерируется в фоне (в AI_EXECUTOR),
+    а deliver() показывает его пользователю по мере готовности — черновиком без клавиатуры,
+    который дописывается через edit_message_text (сообщение с reply-клавиатурой Bot API
+    править не даёт). Итог уходит отдельным сообщением с главным меню, черновик удаляется.
+    До deliver() ответ можно отменить."""
+
+    def __init__(self, text: str, chat_id: int):
+        self.parts: "queue.Queue[Optional[str]]" = queue.Queue()
+        self.cancelled = threading.Event()
+        AI_EXECUTOR.submit(self._run, text, chat_id)
+
+    def _run(self, text: str, chat_id: int):
+        got = []
+        try:
+            quick = quick_reply(text)
+            if quick:
+                self.parts.put(quick)
+                return
+            # отменили, пока задача стояла в очереди, — платный запрос уже не нужен
+            if self.cancelled.is_set():
+                return
+            stream = reply_request(text, chat_id, stream=True)
+            try:
+                for chunk in stream:
+                    if self.cancelled.is_set():
+                        break
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        got.append(delta)
+                        self.parts.put(delta)
+            finally:
+                stream.close()
+        except Exception as e:
+            log.error(f"[OpenAI] stream error: {e}")
+            if not got:
+                self.parts.put(AI_ERROR_TEXT)
+        finally:
+            self.parts.put(None)
+
+    def cancel(self):
+        """Ответ не понадобился — прерываем генерацию"""
+        self.cancelled.set()
+
+    def deliver(self, chat_id: int) -> str:
+        """Отправляет ответ по мере генерации, возвращает итоговый текст"""
+        buf, sent, draft = "", "", None
+        next_edit = 0.0
+        finished = False
+        while not finished:
+            # есть неотправленный текст — ждём не дольше, чем до следующей правки
+            timeout = max(0.0, next_edit - time.monotonic()) if buf != sent else None
+            try:
+                part = self.parts.get(timeout=timeout)
+            except queue.Empty:
+                part = ""
+            if part is None:
+                finished = True
+            else:
+                buf += part
+            now = time.monotonic()
+            # промежуточные версии — в черновик; итог отправляется ниже целиком
+            if not finished and buf.strip() and buf != sent and now >= next_edit:
+                try:
+                    if draft is None:
+                        draft = bot.send_message(chat_id, buf)
+                    else:
+                        bot.edit_message_text(buf, chat_id, draft.message_id)
+                except Exception as e:
+                    log.error(f"[Telegram] stream send error: {e}")
+                sent, next_edit = buf, now + STREAM_EDIT_INTERVAL
+
+        reply = buf.strip() or AI_ERROR_TEXT
+        # Полный текст — новым сообщением с меню (его никто не правит), поэтому сбой
+        # промежуточной правки не обрезает ответ
+        bot.send_message(chat_id, reply, reply_markup=MAIN_MENU_JSON)
+        if draft is not None:
+            try:
+                bot.delete_message(chat_id, draft.message_id)
+            except Exception as e:
+                log.error(f"[Telegram] stream draft delete error: {e}")
+        return reply
 
 # ------------ Тарифы (единые по всем направлениям) ------------
 PRICING = {
@@ -390,35 +1126,49 @@ PRICING = {
     "срочная": [(50, 110), (100, 130)], # ≤50г — €110; ≤100г — €130
 }
 
-def base_price(weight: int, tariff_table):
-    for thr, price in tariff_table:
-        if weight <= thr:
-            return price, thr
+# Пороги веса и цены — параллельными списками для bisect
+_PRICE_STEPS = {
+    urgency: ([thr for thr, _ in table], [price for _, price in table])
+    for urgency, table in PRICING.items()
+}
+
+def base_price(weight: int, urgency: str):
+    thresholds, prices = _PRICE_STEPS[urgency]
+    i = bisect_left(thresholds, weight)
+    if i < len(thresholds):
+        return prices[i], thresholds[i]
     return None, None
 
+def str_field(d: Dict, key: str) -> str:
+    """Значение поля как обрезанная строка (без лишних str()/or-цепочек)"""
+    v = d.get(key)
+    if isinstance(v, str):
+        return v.strip()
+    return "" if v is None else str(v).strip()
+
+# 'База' ориентировочных сроков в РАБОЧИХ днях по маршрутам.
+# Россия/Беларусь → Украина и прочие маршруты — None (требует подтверждения)
+_ROUTE_ETA = {
+    ("Украина", "Россия"): "27–29",
+    ("Украина", "Беларусь"): "21–23",
+}
+
 def eta_working_days(from_country: str, to_country: str) -> Optional[str]:
-    """'База' ориентировочных сроков в РАБОЧИХ днях по маршрутам."""
-    fc = (from_country or "").title()
-    tc = (to_country or "").title()
-    if fc == "Украина" and tc == "Россия":
-        return "27–29"
-    if fc == "Украина" and tc == "Беларусь":
-        return "21–23"
-    if fc in {"Россия", "Беларусь"} and tc == "Украина":
-        return None  # требует подтверждения
-    return None  # неизвестный маршрут
+    route = (from_country, to_country)
+    if route not in _ROUTE_ETA:
+        # страны из визарда уже канонические; title() — только для старых записей
+        route = ((from_country or "").title(), (to_country or "").title())
+    return _ROUTE_ETA.get(route)
 
 def compute_quote(d: Dict) -> Dict:
-    fc = (d.get("from_country", "") or "").title()
-    tc = (d.get("to_country", "") or "").title()
     w  = int(d.get("weight_grams") or 0)
 
-    urgency = (d.get("urgency") or "обычная").strip().lower()
+    urgency = str_field(d, "urgency").lower()
     if urgency not in PRICING:
         urgency = "обычная"
 
-    price, thr = base_price(w, PRICING[urgency])
-    eta_work = eta_working_days(fc, tc)
+    price, thr = base_price(w, urgency)
+    eta_work = eta_working_days(d.get("from_country"), d.get("to_country"))
 
     if w == 0 or price is None:
         return {
@@ -440,16 +1190,75 @@ def compute_quote(d: Dict) -> Dict:
     }
 
 # ------------ Уведомление админу (НЕ пользователю) ------------
-def notify_admin_lead(source_chat_id: int, payload: Dict):
-    """Отправляет карточку лида администратору. Пользователю НЕ показывается."""
+# Сообщения админу уходят из фонового потока и не задерживают ответ пользователю
+ADMIN_QUEUE: "queue.Queue[Tuple[str, Optional[str]]]" = queue.Queue(maxsize=1000)
+
+# Уведомления, пришедшие в пределах окна, склеиваются в одно сообщение:
+# меньше запросов к Telegram и меньше шансов упереться в его rate limit
+ADMIN_BATCH_WINDOW = 0.5
+ADMIN_BATCH_SEP = "\n\n---\n\n"
+TG_MESSAGE_LIMIT = 4096
+
+def _admin_send(text: str, parse_mode: Optional[str]):
+    for _ in range(3):
+        try:
+            bot.send_message(ADMIN_CHAT_ID, text, parse_mode=parse_mode)
+            return
+        except apihelper.ApiTelegramException as e:
+            if e.error_code != 429:
+                log.error(f"[ADMIN notify] send error: {e}")
+                return
+            retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+            log.warning(f"[ADMIN notify] 429, повтор через {retry_after} с")
+            time.sleep(retry_after + random.uniform(0, 0.5))
+        except Exception as e:
+            log.error(f"[ADMIN notify] send error: {e}")
+            return
+    log.warning("[ADMIN notify] не удалось отправить после повторов — уведомление отброшено")
+
+def _admin_worker():
+    while True:
+        batch = [ADMIN_QUEUE.get()]
+        deadline = time.monotonic() + ADMIN_BATCH_WINDOW
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(ADMIN_QUEUE.get(timeout=timeout))
+            except queue.Empty:
+                break
+
+        # склеиваем подряд идущие сообщения с одинаковым parse_mode, не выходя за лимит Telegram
+        text, parse_mode = batch[0]
+        for t, mode in batch[1:]:
+            if mode == parse_mode and len(text) + len(ADMIN_BATCH_SEP) + len(t) <= TG_MESSAGE_LIMIT:
+                text += ADMIN_BATCH_SEP + t
+            else:
+                _admin_send(text, parse_mode)
+                text, parse_mode = t, mode
+        _admin_send(text, parse_mode)
+
+threading.Thread(target=_admin_worker, name="admin-notify", daemon=True).start()
+
+def notify_admin(text: str, parse_mode: Optional[str] = None):
+    """Ставит сообщение админу в очередь (не блокирует)"""
+    try:
+        ADMIN_QUEUE.put_nowait((text, parse_mode))
+    except queue.Full:
+        log.warning("[ADMIN notify] очередь переполнена — уведомление отброшено")
+
+def notify_admin_lead(source_chat_id: int, payload: Dict, quote: Optional[Dict] = None):
+    """Отправляет карточку лида администратору. Пользователю НЕ показывается.
+    quote — уже посчитанная оценка (чтобы не считать её второй раз)."""
     if not ADMIN_CHAT_ID:
-        print("[ADMIN] ADMIN_CHAT_ID не задан — уведомление не отправлено")
+        log.warning("[ADMIN] ADMIN_CHAT_ID не задан — уведомление не отправлено")
         return
     if ADMIN_CHAT_ID == source_chat_id:
-        print("[ADMIN] ADMIN_CHAT_ID совпадает с chat_id пользователя — уведомление пропущено (тестовый режим).")
+        log.warning("[ADMIN] ADMIN_CHAT_ID совпадает с chat_id пользователя — уведомление пропущено (тестовый режим).")
         return
     try:
-        q = compute_quote(payload)
+        q = quote or compute_quote(payload)
         price_line = f"Оценка: €{q['price_eur']} (до {q['threshold_g']} г)" if q["price_eur"] is not None else "Оценка: по согласованию"
         eta_line = (
             f"Срок: ориентировочно {q['eta_working']} рабочих дней" if q.get("eta_working")
@@ -457,8 +1266,8 @@ def notify_admin_lead(source_chat_id: int, payload: Dict):
         )
         note_line = f"Примечание: {q['notes']}" if q.get("notes") else None
         lines = [
-            "🟢 *Новый лид (DocuBridge)*",
-            f"Chat ID: `{source_chat_id}`",
+            "🟢 НОВЫЙ ЛИД (DocuBridge)",
+            f"Chat ID: {source_chat_id}",
             "",
             f"Тип документа: {payload.get('doc_type', '—')}",
             f"Маршрут: {payload.get('from_country')}/{payload.get('from_city')} → {payload.get('to_country')}/{payload.get('to_city')}",
@@ -477,9 +1286,11 @@ def notify_admin_lead(source_chat_id: int, payload: Dict):
             f"Email: {payload.get('email', '—')}",
             f"Лучшее время связи: {payload.get('best_time', '—')}",
         ]
-        bot.send_message(ADMIN_CHAT_ID, "\n".join(lines), parse_mode="Markdown")
+        # Без parse_mode: поля приходят от пользователей, и «_»/«*» в имени или
+        # email ломали бы Markdown-разметку — Telegram отклонял бы сообщение целиком
+        notify_admin("\n".join(lines))
     except Exception as e:
-        print(f"[ADMIN notify] lead notify error: {e}")
+        log.error(f"[ADMIN notify] lead notify error: {e}")
 
 # ------------ Визард ------------
 COUNTRY_CHOICES = ["Украина", "Россия", "Беларусь"]
@@ -499,6 +1310,13 @@ FIELDS = [
     {"key": "best_time", "type": "text", "q": "Когда вам удобнее принимать звонок/сообщение?"},
 ]
 
+# Производное от FIELDS считаем один раз при импорте
+FIELD_INDEX = {f["key"]: i for i, f in enumerate(FIELDS)}
+QUESTIONS = [
+    f["q"] + (f" [{', '.join(f['choices'])}]" if f["type"] == "choice" else "")
+    for f in FIELDS
+]
+
 RUS_NUMS = {
     "ноль": 0, "один": 1, "два": 2, "три": 3, "четыре": 4, "пять": 5,
     "шесть": 6, "семь": 7, "восемь": 8, "девять": 9, "десять": 10,
@@ -508,46 +1326,67 @@ RUS_NUMS = {
     "семьдесят": 70, "восемьдесят": 80, "девяносто": 90, "сто": 100
 }
 
+# Десятки (и «сто»): к ним может прибавиться следующее слово — «двадцать пять»
+RUS_TENS = frozenset(v for v in RUS_NUMS.values() if v >= 20 and v % 10 == 0)
+
+_DIGITS_RE = re.compile(r"\d+")
+# Числительные целыми словами: одна альтернатива (длинные первыми), в findall попадают
+# только известные слова — отдельная проверка по словарю не нужна
+_RUS_NUM_RE = re.compile(
+    r"(?<![а-яё])(?:" + "|".join(sorted(RUS_NUMS, key=len, reverse=True)) + r")(?![а-яё])"
+)
+
 def parse_int(text: str) -> Optional[int]:
     if not text:
         return None
-    s = text.strip().lower()
-    m = re.search(r"\d+", s)
+    s = text.strip()
+    # Самый частый ответ — просто число: ни регулярок, ни кэша
+    if s.isascii() and s.isdigit():
+        return int(s)
+    return _parse_int_norm(s.lower())
+
+# Ответы на «сколько листов» сильно повторяются («10», «двадцать», «сто»)
+@lru_cache(maxsize=4096)
+def _parse_int_norm(s: str) -> Optional[int]:
+    m = _DIGITS_RE.search(s)
     if m:
-        try:
-            return int(m.group())
-        except Exception:
-            pass
-    tokens = re.findall(r"[а-яё]+", s)
+        return int(m.group())
     total = 0
     last = 0
     seen = False
-    for t in tokens:
-        if t in RUS_NUMS:
-            seen = True
-            val = RUS_NUMS[t]
-            if val >= 20 and val % 10 == 0:
-                last = val
+    for t in _RUS_NUM_RE.findall(s):
+        val = RUS_NUMS[t]
+        seen = True
+        if val in RUS_TENS:
+            last = val
+        else:
+            if last:
+                total += last + val
+                last = 0
             else:
-                if last:
-                    total += last + val
-                    last = 0
-                else:
-                    total += val
+                total += val
     if seen:
         return total if total > 0 else (last if last > 0 else None)
     return None
 
+_EMAIL_RE = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", re.I)
+_NAME_RE = re.compile(r"^[A-Za-zА-Яа-яЁё\-'\s]{2,}$")
+
+# field_filled перепроверяет одни и те же сохранённые значения анкеты при каждом
+# проходе first_missing_index — результат валидации строки запоминаем
+@lru_cache(maxsize=4096)
 def valid_email(s: str) -> bool:
-    return bool(re.match(r"^[^@\s]+@[^@\s]+\.[^@\s]+$", s.strip(), flags=re.I))
+    return bool(_EMAIL_RE.match(s.strip()))
+
+PHONE_PREFIXES = ("+380", "+7", "+375")
 
 def valid_phone(s: str) -> bool:
-    s = s.strip().replace(" ", "")
-    return s.startswith("+380") or s.startswith("+7") or s.startswith("+375")
+    return s.strip().replace(" ", "").startswith(PHONE_PREFIXES)
 
+@lru_cache(maxsize=4096)
 def valid_name(s: str) -> bool:
     s = s.strip()
-    return bool(re.match(r"^[A-Za-zА-Яа-яЁё\-'\s]{2,}$", s))
+    return bool(_NAME_RE.match(s))
 
 # ------------ ИИ + ЭВРИСТИКИ: распознавание намерений ------------
 AI_KEYS = {"doc_type","from_country","from_city","to_country","to_city","pages_a4","weight_grams","urgency","name","phone","email","best_time"}
@@ -562,14 +1401,22 @@ URGENCY_SYNONYMS = {
     ],
 }
 
+# По одному регулярному выражению на метку; порядок меток (сначала «срочная») сохраняется
+_URGENCY_RES = [
+    (label, re.compile("|".join(map(re.escape, words))))
+    for label, words in URGENCY_SYNONYMS.items()
+]
+
 def infer_urgency(text: str) -> Optional[str]:
     s = (text or "").lower()
-    for label, words in URGENCY_SYNONYMS.items():
-        for w in words:
-            if w in s:
-                return label
+    for label, rx in _URGENCY_RES:
+        if rx.search(s):
+            return label
     return None
 
+_WEIGHT_RE = re.compile(r"(\d+)\s*(?:г|гр|грамм)")
+_PAGES_RE = re.compile(r"(\d+)\s*(?:стр|лист)")
+
 def heuristic_parse(text: str) -> Optional[Dict[str, Any]]:
     """Быстрый локальный парсер: вытаскивает срочность/страницы/вес без ИИ."""
     if not text:
@@ -581,8 +1428,10 @@ def heuristic_parse(text: str) -> Optional[Dict[str, Any]]:
     if u:
         out["urgency"] = u
 
+    low = text.lower()
+
     # вес, г
-    m = re.search(r"(\d+)\s*(?:г|гр|грамм)", text.lower())
+    m = _WEIGHT_RE.search(low)
     if m:
         try:
             out["weight_grams"] = int(m.group(1))
@@ -590,7 +1439,7 @@ def heuristic_parse(text: str) -> Optional[Dict[str, Any]]:
             pass
 
     # страницы
-    m = re.search(r"(\d+)\s*(?:стр|лист)", text.lower())
+    m = _PAGES_RE.search(low)
     if m:
         try:
             out["pages_a4"] = int(m.group(1))
@@ -605,47 +1454,57 @@ def heuristic_parse(text: str) -> Optional[Dict[str, Any]]:
 
     return out or None
 
+COUNTRY_ALIASES = {
+    "украина":"Украина","ukraine":"Украина","ua":"Украина",
+    "россия":"Россия","rf":"Россия","ru":"Россия","russia":"Россия",
+    "беларусь":"Беларусь","рб":"Беларусь","by":"Беларусь","belarus":"Беларусь",
+}
+ALLOWED_COUNTRIES = frozenset(COUNTRY_CHOICES)
+
+URGENCY_NORMAL = frozenset({"обычная","standard","normal","базовый","стандартный"})
+URGENCY_EXPRESS = frozenset({"срочная","express","urgent","ускоренная","ускоренный","экспресс"})
+
 def normalize_country(x: Optional[str]) -> Optional[str]:
     if not x: return None
-    s = x.strip().lower()
-    mapping = {
-        "украина":"Украина","ukraine":"Украина","ua":"Украина",
-        "россия":"Россия","rf":"Россия","ru":"Россия","russia":"Россия",
-        "беларусь":"Беларусь","рб":"Беларусь","by":"Беларусь","belarus":"Беларусь",
-    }
-    return mapping.get(s, x.strip().title())
+    s = x.strip()
+    return COUNTRY_ALIASES.get(s.lower(), s.title())
 
 def normalize_urgency(x: Optional[str]) -> Optional[str]:
     if not x: return None
     s = x.strip().lower()
-    if s in {"обычная","standard","normal","базовый","стандартный"}: return "обычная"
-    if s in {"срочная","express","urgent","ускоренная","ускоренный","экспресс"}: return "срочная"
+    if s in URGENCY_NORMAL: return "обычная"
+    if s in URGENCY_EXPRESS: return "срочная"
     return None
 
-def ai_understand(text: str) -> Optional[Dict[str, Any]]:
+def ai_understand(text: str, chat_id: Optional[int] = None) -> Optional[Dict[str, Any]]:
     """Пытается извлечь JSON с полями анкеты из свободного текста пользователя."""
-    if not client:
+    if not AI_ENABLED:
         return None
+    user = "Текст пользователя:\n" + text
+    # Извлечение идёт при temperature=0, поэтому результат для одного текста стабилен
+    # и кэшируется всегда (в т.ч. «ничего не нашли» — как пустой dict)
+    if has_contact_data(text):
+        return _extract_fields(user, chat_id, None)
+    key = ai_cache_key(AI_MODEL, SYS_EXTRACT, user)
+    cached = ai_cache_get(key)
+    if cached is not None:
+        return dict(cached) if cached else None
+    result = single_flight(key, lambda: _extract_fields(user, chat_id, key))
+    return dict(result) if result else None
+
+def _extract_fields(user: str, chat_id: Optional[int], key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Запрос к модели и чистка ответа для ai_understand"""
     try:
-        system = (
-            "Ты логистический ассистент DocuBridge. "
-            "Тебе дают свободный текст. Извлеки поля заявки "
-            "(doc_type, from_country, from_city, to_country, to_city, pages_a4, weight_grams, urgency, name, phone, email, best_time). "
-            "Верни ТОЛЬКО валидный JSON-объект без лишнего текста. Неуказанные поля не включай."
-        )
-        user = "Текст пользователя:\n" + text
-        r = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role":"system","content":system},{"role":"user","content":user}],
-            temperature=0.2,
-            max_tokens=400,
-            timeout=30
+        r = ai_client().chat.completions.create(
+            model=AI_MODEL,
+            messages=[{"role":"system","content":SYS_EXTRACT},{"role":"user","content":user}],
+            temperature=0,
+            max_tokens=200,
+            timeout=30,
+            response_format={"type": "json_object"},
+            **ai_user_kwargs(chat_id, "extract"),
         )
-        raw = (r.choices[0].message.content or "").strip()
-        m = re.search(r"\{.*\}", raw, flags=re.S)
-        if not m:
-            return None
-        data = json.loads(m.group(0))
+        data = orjson.loads(r.choices[0].message.content or "{}")
         if not isinstance(data, dict):
             return None
 
@@ -662,7 +1521,7 @@ def ai_understand(text: str) -> Optional[Dict[str, Any]]:
                     pass
             elif k in {"from_country","to_country"}:
                 nv = normalize_country(str(v))
-                if nv:
+                if nv in ALLOWED_COUNTRIES:
                     cleaned[k] = nv
             elif k == "urgency":
                 nu = normalize_urgency(str(v))
@@ -685,44 +1544,45 @@ def ai_understand(text: str) -> Optional[Dict[str, Any]]:
             if pages > 0:
                 cleaned["weight_grams"] = pages * 6
 
+        if key:
+            ai_cache_put(key, dict(cleaned))
         return cleaned if cleaned else None
     except Exception as e:
-        print(f"[OpenAI] ai_understand error: {e}")
+        log.error(f"[OpenAI] ai_understand error: {e}")
         return None
 
-def first_missing_index(data: Dict) -> int:
-    """Возвращает индекс первого незаполненного поля по FIELDS; если всё заполнено — len(FIELDS)."""
-    def is_filled(field, value) -> bool:
-        t = field["type"]
-        if value is None:
-            return False
-        s = str(value).strip() if not isinstance(value, int) else value
-        if t == "text":
-            return bool(s) and len(str(s)) >= 1
-        if t == "choice":
-            return str(value).strip() in field["choices"]
-        if t == "int":
-            try:
-                return int(value) > 0
-            except Exception:
-                return False
-        if t == "int_opt":
-            try:
-                iv = int(value)
-                return iv >= 0
-            except Exception:
-                return False
-        if t == "phone":
-            return valid_phone(str(value))
-        if t == "email":
-            return valid_email(str(value))
-        if t == "name":
-            return valid_name(str(value))
+def field_filled(field: Dict, value: Any) -> bool:
+    """Заполнено ли поле анкеты допустимым значением"""
+    if value is None:
         return False
+    t = field["type"]
+    if t == "text":
+        return bool(value) if isinstance(value, int) else bool(str(value).strip())
+    if t == "choice":
+        return str(value).strip() in field["choices"]
+    if t == "int":
+        try:
+            return int(value) > 0
+        except Exception:
+            return False
+    if t == "int_opt":
+        try:
+            return int(value) >= 0
+        except Exception:
+            return False
+    if t == "phone":
+        return valid_phone(str(value))
+    if t == "email":
+        return valid_email(str(value))
+    if t == "name":
+        return valid_name(str(value))
+    return False
 
+def first_missing_index(data: Dict) -> int:
+    """Возвращает индекс первого незаполненного поля по FIELDS; если всё заполнено — len(FIELDS)."""
+    get = data.get
     for i, f in enumerate(FIELDS):
-        k = f["key"]
-        if not is_filled(f, data.get(k)):
+        if not field_filled(f, get(f["key"])):
             return i
     return len(FIELDS)
 
@@ -757,14 +1617,26 @@ FIELD_ALIASES = {
     "best_time":     ["время связи", "когда связаться", "лучшее время"],
 }
 
+_ALIAS_RES = [
+    (key, re.compile("|".join(map(re.escape, aliases))))
+    for key, aliases in FIELD_ALIASES.items()
+]
+
 def alias_to_key(text: str) -> Optional[str]:
     s = (text or "").lower()
-    for key, aliases in FIELD_ALIASES.items():
-        for a in aliases:
-            if a in s:
-                return key
+    for key, rx in _ALIAS_RES:
+        if rx.search(s):
+            return key
     return None
 
+# Шаблоны для try_extract_value_for_key — компилируются один раз при импорте
+_COUNTRY_VALUE_RE = re.compile(r"(?:из|в|во)\s+([A-Za-zА-Яа-яЁё\-]+)", re.I)
+_CITY_VALUE_RE = re.compile(r"(?:город|в|из)\s+([A-Za-zА-Яа-яЁё\-\s]{2,})", re.I)
+_PHONE_VALUE_RE = re.compile(r"(\+\d[\d\s\-]{6,})")
+_EMAIL_VALUE_RE = re.compile(r"([A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,})")
+_NAME_VALUE_RE = re.compile(r"(?:меня зовут|мо[её] имя|я\s*[-—]\s*)(.+)", re.I)
+_TIME_VALUE_RE = re.compile(r"(после|до|в)\s+[^,.!?]+", re.I)
+
 def try_extract_value_for_key(key: str, text: str) -> Optional[Any]:
     s = (text or "").strip()
 
@@ -774,10 +1646,10 @@ def try_extract_value_for_key(key: str, text: str) -> Optional[Any]:
             return syn
 
     if key in {"pages_a4", "weight_grams"}:
-        m = re.search(r"(\d+)", s.lower())
+        m = _DIGITS_RE.search(s)
         if m:
             try:
-                val = int(m.group(1))
+                val = int(m.group())
                 if key == "pages_a4" and val >= 0:
                     return val
                 if key == "weight_grams" and val >= 0:
@@ -787,33 +1659,33 @@ def try_extract_value_for_key(key: str, text: str) -> Optional[Any]:
         return None
 
     if key in {"from_country", "to_country"}:
-        m = re.search(r"(?:из|в|во)\s+([A-Za-zА-Яа-яЁё\-]+)", s, flags=re.I)
+        m = _COUNTRY_VALUE_RE.search(s)
         cand = m.group(1) if m else s
         return normalize_country(cand)
 
     if key in {"from_city", "to_city"}:
-        m = re.search(r"(?:город|в|из)\s+([A-Za-zА-Яа-яЁё\-\s]{2,})", s, flags=re.I)
+        m = _CITY_VALUE_RE.search(s)
         return (m.group(1).strip().title() if m else None)
 
     if key == "phone":
-        m = re.search(r"(\+\d[\d\s\-]{6,})", s)
+        m = _PHONE_VALUE_RE.search(s)
         if m:
             cand = m.group(1).replace(" ", "")
             return cand if valid_phone(cand) else None
 
     if key == "email":
-        m = re.search(r"([A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,})", s)
+        m = _EMAIL_VALUE_RE.search(s)
         if m:
             return m.group(1) if valid_email(m.group(1)) else None
 
     if key == "name":
-        m = re.search(r"(?:меня зовут|мо[её] имя|я\s*[-—]\s*)(.+)", s, flags=re.I)
+        m = _NAME_VALUE_RE.search(s)
         if m:
             cand = m.group(1).strip()
             return cand if valid_name(cand) else None
 
     if key == "best_time":
-        m = re.search(r"(после|до|в)\s+[^,.!?]+", s, flags=re.I)
+        m = _TIME_VALUE_RE.search(s)
         return m.group(0) if m else s
 
     if key == "doc_type":
@@ -821,12 +1693,14 @@ def try_extract_value_for_key(key: str, text: str) -> Optional[Any]:
 
     return None
 
+_JUMP_RE = re.compile(r"верни|вернуть|вернись|исправ|поправ|измен|поменя|коррект")
+
 def detect_jump_or_edit(text: str) -> Tuple[Optional[str], Optional[Any]]:
     """Возвращает (key, new_value) для команд: верни/исправь/поменяй ... [на <значение>]"""
     s = (text or "").lower()
     if not s:
         return (None, None)
-    if any(w in s for w in ["верни", "вернуть", "вернись", "исправ", "поправ", "измен", "поменя", "коррект"]):
+    if _JUMP_RE.search(s):
         key = alias_to_key(s)
         if not key:
             return (None, None)
@@ -835,115 +1709,60 @@ def detect_jump_or_edit(text: str) -> Tuple[Optional[str], Optional[Any]]:
     return (None, None)
 
 # ------------ UI / Диалог ------------
-def ask(chat_id: int, idx: int, data: Dict):
-    field = FIELDS[idx]
-    q = field["q"]
-
-    if field["type"] == "choice":
-        q += f" [{', '.join(field['choices'])}]"
-
-    kb = None
-    if field["type"] == "choice":
-        kb = ReplyKeyboardMarkup(
-            resize_keyboard=True,
-            one_time_keyboard=True,
-            input_field_placeholder="Выберите вариант на клавиатуре ниже"
-        )
-        row = []
-        for choice in field["choices"]:
-            row.append(KeyboardButton(choice))
-            if len(row) == 3:
-                kb.add(*row)
-                row = []
-        if row:
+def _build_choice_keyboard(choices: List[str]) -> ReplyKeyboardMarkup:
+    kb = ReplyKeyboardMarkup(
+        resize_keyboard=True,
+        one_time_keyboard=True,
+        input_field_placeholder="Выберите вариант на клавиатуре ниже"
+    )
+    row = []
+    for choice in choices:
+        row.append(KeyboardButton(choice))
+        if len(row) == 3:
             kb.add(*row)
+            row = []
+    if row:
+        kb.add(*row)
+    return kb
 
-    save_message(chat_id, None, q)
-    bot.send_message(chat_id, q, reply_markup=kb if kb else None)
-
-def handle_answer(chat_id: int, text: str):
-    print(f"[Handler] handle_answer called: chat_id={chat_id}, text='{text}'")
-
-    state, data = get_state(chat_id)
-    save_message(chat_id, text, None)
-
-    # 🔹 Команды "верни/исправь": переход на нужный шаг, опционально сразу применяем новое значение
-    jump_key, new_val = detect_jump_or_edit(text)
-    if jump_key:
-        data = (data or {})
-        if new_val is not None:
-            data[jump_key] = new_val
-            if jump_key == "pages_a4" and int(data.get("weight_grams") or 0) == 0:
-                try:
-                    pages = int(new_val)
-                    if pages > 0:
-                        data["weight_grams"] = pages * 6
-                except:
-                    pass
-            update_data(chat_id, data)
-            idx = first_missing_index(data)
-            if idx >= len(FIELDS):
-                return finalize_form(chat_id, data, last_user_text=text)
-        else:
-            idx = next((i for i, f in enumerate(FIELDS) if f["key"] == jump_key), 0)
+# Варианты ответов — константы, поэтому клавиатуры шагов-выборов собираем и
+# сериализуем один раз (как MAIN_MENU_JSON), а не на каждый вопрос
+CHOICE_KEYBOARDS_JSON = {
+    i: _build_choice_keyboard(f["choices"]).to_json()
+    for i, f in enumerate(FIELDS) if f["type"] == "choice"
+}
+REMOVE_KEYBOARD_JSON = ReplyKeyboardRemove().to_json()
 
-        data["_idx"] = idx
-        set_state(chat_id, "collecting", data)
-        bot.send_message(chat_id, "Ок, вернул к запрошенному шагу. Уточните, пожалуйста.", reply_markup=ReplyKeyboardRemove())
-        ask(chat_id, idx, data)
-        return
+def ask(chat_id: int, idx: int, data: Dict, prefix: Optional[str] = None):
+    """Задаёт вопрос шага idx. prefix (подтверждение/ошибка) уходит тем же сообщением —
+    один вызов Bot API вместо двух."""
+    field = FIELDS[idx]
+    q = QUESTIONS[idx]
 
-    # ВНЕ визарда: сначала эвристика, потом ИИ
-    if state != "collecting":
-        parsed = heuristic_parse(text) or ai_understand(text)
-        if parsed:
-            print(f"[AI] Parsed intent: {parsed}")
-            data = merge_ai_data({}, parsed)
-            idx = first_missing_index(data)
-            if idx >= len(FIELDS):
-                return finalize_form(chat_id, data, last_user_text=text)
-            else:
-                data["_idx"] = idx
-                set_state(chat_id, "collecting", data)
-                bot.send_message(chat_id, "Понял вас. Давайте уточним пару моментов.", reply_markup=ReplyKeyboardRemove())
-                ask(chat_id, idx, data)
-                return
+    kb = CHOICE_KEYBOARDS_JSON.get(idx)
 
-        reply = ai_reply(text)
-        save_message(chat_id, text, reply)
-        bot.send_message(chat_id, reply, reply_markup=main_menu())
-        return
+    if prefix:
+        q = f"{prefix}\n{q}"
+        # раньше префикс шёл отдельным сообщением и убирал клавиатуру прошлого шага
+        if not kb:
+            kb = REMOVE_KEYBOARD_JSON
 
-    # В ВИЗАРДЕ: пробуем распознать текст, но применяем ТОЛЬКО если данные реально изменились
-    data = data or {}
-    ai_try = heuristic_parse(text) or ai_understand(text)
-    if ai_try:
-        before = dict(data)
-        merged = merge_ai_data(data, ai_try)
-        if merged != before:
-            print(f"[AI] In-wizard parsed & applied: {ai_try}")
-            data = merged
-            idx = first_missing_index(data)
-            if idx >= len(FIELDS):
-                return finalize_form(chat_id, data, last_user_text=text)
-            else:
-                data["_idx"] = idx
-                update_data(chat_id, data)
-                bot.send_message(chat_id, "Принято. Продолжим.", reply_markup=ReplyKeyboardRemove())
-                ask(chat_id, idx, data)
-                return
-        # иначе ИИ ничего полезного не добавил — идём на обычную валидацию
+    save_message(chat_id, None, q)
+    bot.send_message(chat_id, q, reply_markup=kb)
 
-    # обычная пошаговая валидация
+def current_idx(data: Dict) -> int:
+    """Индекс текущего шага визарда (битое значение → с начала)"""
     idx = int(data.get("_idx", 0))
     if idx < 0 or idx >= len(FIELDS):
         idx = 0
-    field = FIELDS[idx]
+    return idx
+
+def parse_field_value(field: Dict, s: str) -> Tuple[Any, Optional[str]]:
+    """Валидирует ответ на шаг визарда. Возвращает (значение, текст ошибки или None)."""
     key = field["key"]
     t = field["type"]
     val = None
     err = None
-    s = (text or "").strip()
 
     if t == "text":
         val = s if len(s) >= 1 else None
@@ -958,7 +1777,7 @@ def handle_answer(chat_id: int, text: str):
                 s_norm = syn
         if s_norm in norm_map:
             val = norm_map[s_norm]
-            print(f"[Handler] Choice accepted: '{s}' -> '{val}'")
+            log.debug("[Handler] Choice accepted: '%s' -> '%s'", s, val)
         else:
             err = f"Пожалуйста, выберите из вариантов: {', '.join(field['choices'])}"
     elif t == "int":
@@ -991,51 +1810,160 @@ def handle_answer(chat_id: int, text: str):
             val = s
         else:
             err = "Введите имя/фамилию (буквы, пробелы и дефисы; не короче 2 символов)."
+    return val, err
+
+# Шаги, короткий ответ на которые однозначно разбирается локально: ИИ-разбор для них
+# только тратит время и токены. Свободный текст (тип документа, город) сюда не входит —
+# там в одном сообщении часто приходит сразу ползаявки
+LOCAL_FIELD_TYPES = frozenset({"int", "int_opt", "choice", "phone", "email"})
+SHORT_ANSWER_WORDS = 3
+_PHONE_ANSWER_RE = re.compile(r"\+[\d\s\-()]{7,}")
+
+def worth_extracting(text: str) -> bool:
+    """Слишком короткий текст или голое число полей заявки не содержат — ИИ вернёт {}"""
+    s = (text or "").strip()
+    return len(s) >= 4 and not s.isdigit()
+
+def answers_current_step(data: Dict, text: str) -> bool:
+    """True, если text — просто ответ на текущий шаг визарда, принятый его валидатором"""
+    field = FIELDS[current_idx(data)]
+    t = field["type"]
+    if t not in LOCAL_FIELD_TYPES:
+        return False
+    s = (text or "").strip()
+    if t == "phone":
+        if not _PHONE_ANSWER_RE.fullmatch(s):
+            return False
+    elif len(s.split()) > SHORT_ANSWER_WORDS:
+        return False
+    _, err = parse_field_value(field, s)
+    return err is None
+
+def handle_answer(chat_id: int, text: str):
+    log.debug("[Handler] handle_answer called: chat_id=%s, text='%s'", chat_id, text)
+
+    state, data = get_state(chat_id)
+    save_message(chat_id, text, None)
+
+    # ИИ-разбор запускаем сразу (параллельно с остальной работой), но только если
+    # ни эвристика, ни валидатор текущего шага визарда не справляются сами
+    jump_key, new_val = detect_jump_or_edit(text)
+    parsed_local = None
+    parsed_future = None
+    if not jump_key:
+        parsed_local = heuristic_parse(text)
+        if not parsed_local and worth_extracting(text):
+            if state == "collecting" and answers_current_step(data or {}, text):
+                log.debug("[AI] extraction skipped: answer to '%s'", FIELDS[current_idx(data or {})]["key"])
+            elif state != "collecting" and canned_reply(text):
+                pass  # приветствие/благодарность: полей заявки там нет, ответим шаблоном
+            else:
+                parsed_future = AI_EXECUTOR.submit(ai_understand, text, chat_id)
+
+    # Вне визарда, если ИИ-разбор не даст полей, понадобится ещё и ответ модели — запускаем
+    # его сразу, параллельно с разбором, а не после. Если поля найдутся, ответ отменим
+    reply_stream = None
+    if parsed_future is not None and state != "collecting":
+        reply_stream = ReplyStream(text, chat_id)
+
+    # 🔹 Команды "верни/исправь": переход на нужный шаг, опционально сразу применяем новое значение
+    if jump_key:
+        data = (data or {})
+        patch = {}
+        if new_val is not None:
+            data[jump_key] = patch[jump_key] = new_val
+            if jump_key == "pages_a4" and int(data.get("weight_grams") or 0) == 0:
+                try:
+                    pages = int(new_val)
+                    if pages > 0:
+                        data["weight_grams"] = patch["weight_grams"] = pages * 6
+                except:
+                    pass
+            idx = first_missing_index(data)
+            if idx >= len(FIELDS):
+                return finalize_form(chat_id, data, last_user_text=text)
+        else:
+            idx = FIELD_INDEX.get(jump_key, 0)
+
+        # новое значение и шаг — одной записью; уже в визарде шлём только изменённые ключи
+        data["_idx"] = patch["_idx"] = idx
+        if state == "collecting":
+            merge_data(chat_id, patch)
+        else:
+            set_state(chat_id, "collecting", data)
+        ask(chat_id, idx, data, prefix="Ок, вернул к запрошенному шагу. Уточните, пожалуйста.")
+        return
+
+    # сначала эвристика, потом ИИ
+    parsed = parsed_local or (parsed_future.result() if parsed_future else None)
+
+    # ВНЕ визарда
+    if state != "collecting":
+        if parsed:
+            log.debug("[AI] Parsed intent: %s", parsed)
+            if reply_stream:
+                reply_stream.cancel()
+            data = merge_ai_data({}, parsed)
+            idx = first_missing_index(data)
+            if idx >= len(FIELDS):
+                return finalize_form(chat_id, data, last_user_text=text)
+            else:
+                data["_idx"] = idx
+                set_state(chat_id, "collecting", data)
+                ask(chat_id, idx, data, prefix="Понял вас. Давайте уточним пару моментов.")
+                return
+
+        reply = (reply_stream or ReplyStream(text, chat_id)).deliver(chat_id)
+        save_message(chat_id, text, reply)
+        return
+
+    # В ВИЗАРДЕ: пробуем распознать текст, но применяем ТОЛЬКО если данные реально изменились
+    data = data or {}
+    if parsed:
+        before = dict(data)
+        merged = merge_ai_data(data, parsed)
+        if merged != before:
+            log.debug("[AI] In-wizard parsed & applied: %s", parsed)
+            data = merged
+            idx = first_missing_index(data)
+            if idx >= len(FIELDS):
+                return finalize_form(chat_id, data, last_user_text=text)
+            else:
+                patch = {k: v for k, v in data.items() if k not in before or before[k] != v}
+                data["_idx"] = patch["_idx"] = idx
+                merge_data(chat_id, patch)
+                ask(chat_id, idx, data, prefix="Принято. Продолжим.")
+                return
+        # иначе ИИ ничего полезного не добавил — идём на обычную валидацию
+
+    # обычная пошаговая валидация
+    idx = current_idx(data)
+    field = FIELDS[idx]
+    key = field["key"]
+    val, err = parse_field_value(field, (text or "").strip())
 
     if err:
-        save_message(chat_id, None, err)
-        bot.send_message(chat_id, err)
-        ask(chat_id, idx, data)
+        ask(chat_id, idx, data, prefix=err)
         return
 
     data[key] = val
+    patch = {key: val}
 
     if key == "pages_a4":
         pages = int(val or 0)
         if pages > 0 and int(data.get("weight_grams") or 0) == 0:
-            data["weight_grams"] = pages * 6
+            data["weight_grams"] = patch["weight_grams"] = pages * 6
 
     idx += 1
     if idx < len(FIELDS):
-        data["_idx"] = idx
-        update_data(chat_id, data)
-        bot.send_message(chat_id, "Принято.", reply_markup=ReplyKeyboardRemove())
-        ask(chat_id, idx, data)
+        data["_idx"] = patch["_idx"] = idx
+        merge_data(chat_id, patch)
+        ask(chat_id, idx, data, prefix="Принято.")
         return
 
     finalize_form(chat_id, data, last_user_text=text)
 
 def finalize_form(chat_id: int, data: Dict, last_user_text: Optional[str] = None):
-    conn = None
-    try:
-        if DB_URL:
-            conn = get_conn()
-            if not conn:
-                print("[DB] Failed to save lead: no connection")
-            else:
-                cur = conn.cursor()
-                cur.execute(
-                    "INSERT INTO leads(chat_id,payload) VALUES(%s,%s)",
-                    (int(chat_id), psycopg2.extras.Json(data)),
-                )
-                conn.commit()
-                cur.close()
-    except Exception as e:
-        print(f"[DB] INSERT lead error: {e}")
-    finally:
-        if conn:
-            return_conn(conn)
-
     quote = compute_quote(data)
     price_line = (
         f"Стоимость: €{quote['price_eur']} (до {quote['threshold_g']} г)"
@@ -1055,9 +1983,6 @@ def finalize_form(chat_id: int, data: Dict, last_user_text: Optional[str] = None
 
     notes_line = f"{quote['notes']}" if quote.get("notes") else None
 
-    # Уведомляем только админа (не пользователя)
-    notify_admin_lead(chat_id, data)
-
     reply = (
         "✅ Спасибо! Все данные получены.\n"
         f"Маршрут: {data.get('from_city')}, {data.get('from_country')} → "
@@ -1068,27 +1993,50 @@ def finalize_form(chat_id: int, data: Dict, last_user_text: Optional[str] = None
         f"Связаться: {data.get('name')}, {data.get('phone')}, {data.get('email')} ({data.get('best_time')})\n\n"
         "Если всё верно — просто ожидайте ответ нашего специалиста. Если нужно что-то изменить — пройдите опрос снова."
     )
-    save_message(chat_id, last_user_text or "", reply)
-    bot.send_message(chat_id, reply, reply_markup=main_menu())
-    set_state(chat_id, "completed")
+    # Пользователь получает ответ сразу, не дожидаясь записи в БД: порядок с его следующим
+    # сообщением всё равно держит chat_lock. Лид сохраняем даже при сбое отправки
+    try:
+        bot.send_message(chat_id, reply, reply_markup=MAIN_MENU_JSON)
+    finally:
+        # лид, история и финальное состояние — одной транзакцией; данные анкеты сбрасываем,
+        # иначе правка после завершения («измени телефон») оформила бы лид повторно
+        persist_turn(chat_id, last_user_text or "", reply, new_data={}, new_state="completed", lead_payload=data)
+
+        # Уведомляем только админа (не пользователя); отправка идёт в фоне через ADMIN_QUEUE
+        notify_admin_lead(chat_id, data, quote)
 
 # ------------ UI / Handlers ------------
-def main_menu():
+def _build_main_menu() -> ReplyKeyboardMarkup:
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add(KeyboardButton("/consult"))
     kb.add(KeyboardButton("/reset"))
     kb.add(KeyboardButton("/news"))
     return kb
 
+# Меню неизменно — собираем один раз (telebot разметку при отправке не меняет)
+MAIN_MENU = _build_main_menu()
+# telebot пропускает строковую разметку как есть — JSON меню сериализуем тоже один раз
+MAIN_MENU_JSON = MAIN_MENU.to_json()
+
+START_TEXT = (
+    "Добро пожаловать в IS-Logix DocuBridge! 🇸🇰📄\n"
+    "Нажмите /consult чтобы начать расчёт и оформление заявки.\n"
+    "Либо опишите задачу свободным текстом — я постараюсь понять и заполнить анкету автоматически."
+)
+RESET_TEXT = "Сбросил сессию. Нажмите /consult чтобы начать заново."
+NEWS_TEXT = (
+    "Новости DocuBridge: https://t.me/DocuBridgeInfo\n"
+    "Готов помочь с вашим кейсом — /consult."
+)
+
+def reply_with_menu(chat_id: int, user_text: str, msg: str):
+    """Ответ на команду: пишем в историю и отправляем с главным меню"""
+    save_message(chat_id, user_text, msg)
+    bot.send_message(chat_id, msg, reply_markup=MAIN_MENU_JSON)
+
 @bot.message_handler(commands=['start'])
 def start(message):
-    msg = (
-        "Добро пожаловать в IS-Logix DocuBridge! 🇸🇰📄\n"
-        "Нажмите /consult чтобы начать расчёт и оформление заявки.\n"
-        "Либо опишите задачу свободным текстом — я постараюсь понять и заполнить анкету автоматически."
-    )
-    save_message(message.chat.id, "/start", msg)
-    bot.send_message(message.chat.id, msg, reply_markup=main_menu())
+    reply_with_menu(message.chat.id, "/start", START_TEXT)
 
 @bot.message_handler(commands=['consult'])
 def consult(message):
@@ -1099,22 +2047,16 @@ def consult(message):
 @bot.message_handler(commands=['reset'])
 def reset(message):
     set_state(message.chat.id, "greeting", {})
-    msg = "Сбросил сессию. Нажмите /consult чтобы начать заново."
-    save_message(message.chat.id, "/reset", msg)
-    bot.send_message(message.chat.id, msg, reply_markup=main_menu())
+    reply_with_menu(message.chat.id, "/reset", RESET_TEXT)
 
 @bot.message_handler(commands=['news'])
 def news(message):
-    msg = (
-        "Новости DocuBridge: https://t.me/DocuBridgeInfo\n"
-        "Готов помочь с вашим кейсом — /consult."
-    )
-    save_message(message.chat.id, "/news", msg)
-    bot.send_message(message.chat.id, msg, reply_markup=main_menu())
+    reply_with_menu(message.chat.id, "/news", NEWS_TEXT)
 
 @bot.message_handler(commands=['ai'])
 def ai_ping(message):
-    reply = ai_reply("Ответь одним словом: OK")
+    # Проверка доступности OpenAI: мимо кэша и шаблонов — всегда живой запрос
+    reply = fetch_reply("Ответь одним словом: OK", message.chat.id) if AI_ENABLED else AI_OFF_TEXT
     save_message(message.chat.id, "/ai", reply)
     bot.send_message(message.chat.id, f"AI: {reply}")
 
@@ -1123,59 +2065,120 @@ def any_text(message):
     handle_answer(message.chat.id, message.text)
 
 # ------------ Webhook ------------
-@app.route("/", methods=["GET"])
-def index():
-    return "OK", 200
+# Health-check "/" дёргают балансировщик и мониторинг: отвечаем на уровне WSGI,
+# не запуская ради этого полный цикл Flask-запроса
+_HEALTH_HEADERS = [("Content-Type", "text/plain"), ("Content-Length", "2")]
+
+def _health_middleware(wsgi_app):
+    def middleware(environ, start_response):
+        if environ.get("PATH_INFO") == "/" and environ.get("REQUEST_METHOD") in ("GET", "HEAD"):
+            start_response("200 OK", _HEALTH_HEADERS)
+            return [b"OK"] if environ["REQUEST_METHOD"] == "GET" else [b""]
+        return wsgi_app(environ, start_response)
+    return middleware
+
+app.wsgi_app = _health_middleware(app.wsgi_app)
+
+# Апдейты обрабатываются в фоне: Telegram получает 200 сразу, не дожидаясь OpenAI/БД.
+# Размер пула = число сообщений, одновременно ждущих OpenAI/БД в одном процессе
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+EXECUTOR = ThreadPoolExecutor(max_workers=UPDATE_WORKERS, thread_name_prefix="update")
+
+# Апдейты одного чата обрабатываем последовательно, иначе два быстрых ответа
+# подряд перетрут состояние визарда друг друга
+_chat_locks: "weakref.WeakValueDictionary[int, threading.Lock]" = weakref.WeakValueDictionary()
+_chat_locks_guard = threading.Lock()
+
+def chat_lock(chat_id: int) -> threading.Lock:
+    with _chat_locks_guard:
+        lock = _chat_locks.get(chat_id)
+        if lock is None:
+            lock = threading.Lock()
+            _chat_locks[chat_id] = lock
+        return lock
+
+# Ограничение на апдейты в работе + в очереди пула: при всплеске трафика очередь
+# EXECUTOR иначе растёт без предела. Сверх лимита отвечаем 503 — Telegram доставит позже
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "200"))
+_pending_updates = threading.BoundedSemaphore(MAX_PENDING_UPDATES)
+
+def process_update(update: Update):
+    """Обрабатывает апдейт в фоновом потоке (дубли уже отсеяны в telegram_webhook)"""
+    update_id = update.update_id
+    try:
+        log.debug("[Webhook] Processing update_id: %s", update_id)
+
+        chat_id = update.message.chat.id if update.message else update_id
+        # Здесь — вся блокирующая работа (Postgres, OpenAI, Bot API), уже вне потока gunicorn
+        with chat_lock(chat_id):
+            bot.process_new_updates([update])
+        log.debug("[Webhook] Update %s processed successfully", update_id)
+    except Exception as e:
+        log.exception(f"[Webhook] Update {update_id} processing error: {e}")
+    finally:
+        _pending_updates.release()
 
 @app.route(f"/webhook/{WEBHOOK_SECRET}", methods=["POST"])
 def telegram_webhook():
     try:
         if request.headers.get("content-type") == "application/json":
-            json_data = json.loads(request.get_data().decode("utf-8"))
-            update = Update.de_json(json_data)
-
-            update_id = update.update_id
-            print(f"[Webhook] Received update_id: {update_id}")
-
-            if is_update_processed(update_id):
-                print(f"[Webhook] Update {update_id} уже обработан, пропускаем")
+            body = request.get_data(cache=False)
+            # Telegram всегда начинает апдейт с update_id: мусор (сканеры, пустые POST)
+            # отсекаем по первым байтам, не разбирая JSON целиком
+            if body[:1] != b"{" or b'"update_id"' not in body[:64]:
+                log.warning("[Webhook] Not a Telegram update, ignored")
                 return "OK", 200
-
-            mark_update_processed(update_id)
-            print(f"[Webhook] Processing update_id: {update_id}")
-
-            bot.process_new_updates([update])
-            print(f"[Webhook] Update {update_id} processed successfully")
+            update = Update.de_json(orjson.loads(body))
+            log.debug("[Webhook] Received update_id: %s", update.update_id)
+            if not _pending_updates.acquire(blocking=False):
+                log.warning(f"[Webhook] Перегрузка: {MAX_PENDING_UPDATES} апдейтов в работе, update {update.update_id} отклонён")
+                return "Busy", 503
+            # Дубли отсеиваем до постановки в пул: повторная доставка не занимает поток.
+            # Отметка — после захвата слота, иначе отклонённый 503 апдейт при повторе
+            # Telegram'ом сочли бы уже обработанным
+            try:
+                if not claim_update(update.update_id):
+                    log.debug("[Webhook] Update %s уже обработан, пропускаем", update.update_id)
+                    _pending_updates.release()
+                    return "OK", 200
+                EXECUTOR.submit(process_update, update)
+            except Exception:
+                _pending_updates.release()
+                raise
         else:
-            print("[Webhook] Unsupported content-type")
+            log.warning("[Webhook] Unsupported content-type")
     except Exception as e:
-        print("[Webhook] error:", e)
-        traceback.print_exc()
+        log.exception(f"[Webhook] error: {e}")
     return "OK", 200
 
 def ensure_webhook():
     try:
         if not WEBHOOK_BASE:
-            print("❌ ERROR: WEBHOOK_BASE не задан — бот не будет работать!")
-            print("Установите WEBHOOK_BASE в .env файле")
+            log.error("❌ ERROR: WEBHOOK_BASE не задан — бот не будет работать!")
+            log.error("Установите WEBHOOK_BASE в .env файле")
             raise SystemExit(1)
 
         url = f"{WEBHOOK_BASE}/webhook/{WEBHOOK_SECRET}"
         bot.remove_webhook()
-        ok = bot.set_webhook(url=url, drop_pending_updates=True)
+        ok = bot.set_webhook(url=url, max_connections=40, drop_pending_updates=True)
         if ok:
-            print(f"✅ Webhook set to: {url}")
+            log.info(f"✅ Webhook set to: {url}")
         else:
-            print("❌ ERROR: set_webhook returned False")
+            log.error("❌ ERROR: set_webhook returned False")
             raise SystemExit(1)
     except Exception as e:
-        print(f"❌ [Webhook] set error: {e}")
+        log.error(f"❌ [Webhook] set error: {e}")
         raise SystemExit(1)
 
 # ------------ Entrypoint ------------
 init_db_pool()
+# atexit вызывает обработчики в обратном порядке: буфер истории допишется до закрытия пула
+atexit.register(flush_history)
 ensure_tables()
 ensure_webhook()
 
+# Только для локального запуска (`python main.py`). В проде — gunicorn с настройками из
+# gunicorn.conf.py: `gunicorn main:app` (gthread) или
+# `GUNICORN_WORKER_CLASS=gevent gunicorn main:app` (гринлеты, psycopg2 патчится выше)
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=PORT, debug=False)
+    app.run(host="0.0.0.0", port=PORT, debug=False, threaded=True)